@@ -63,6 +63,7 @@ class Config:
     USER_RATE_LIMIT_HOURLY = 40#每小时限制
     USER_RATE_LIMIT_DAILY = 200#每日限制
 
+    CHAT_WORKER_COUNT = 8#处理对话回复的工作线程数
     CMD_MSG_DELETE_DELAY = 30#命令消息删除延时
     ONETIME_CODE_LENGTH = 4#单次验证码长度
 
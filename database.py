@@ -1,7 +1,12 @@
 # database.py
 import sqlite3
 import threading
-import datetime
+import json
+import time
+import queue
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from pathlib import Path
 
 # 1. 在这里添加新表的建表语句
 INIT_SQL = [
@@ -19,7 +24,7 @@ INIT_SQL = [
         chat_type TEXT NOT NULL,
         system_prompt TEXT,
         PRIMARY KEY (user_id, chat_type)
-    )
+    ) WITHOUT ROWID
     """,
     """
     CREATE TABLE IF NOT EXISTS usage (
@@ -28,15 +33,15 @@ INIT_SQL = [
         key TEXT NOT NULL,
         count INTEGER NOT NULL DEFAULT 0,
         PRIMARY KEY (user_id, scope, key)
-    )
+    ) WITHOUT ROWID
     """,
     """
     CREATE TABLE IF NOT EXISTS invitation_codes (
         code TEXT PRIMARY KEY,
         role TEXT NOT NULL,
-        created_at TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
         created_by INTEGER NOT NULL,
-        used_at TEXT,
+        used_at INTEGER,
         used_by INTEGER,
         status TEXT NOT NULL
     )
@@ -48,14 +53,14 @@ INIT_SQL = [
         msg_uuid TEXT NOT NULL,
         role TEXT NOT NULL,
         content TEXT NOT NULL,
-        ts TEXT NOT NULL,
+        ts INTEGER NOT NULL,
         seq INTEGER NOT NULL
     )
     """,
     """
     CREATE TABLE IF NOT EXISTS system_logs (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        ts TEXT NOT NULL,
+        ts INTEGER NOT NULL,
         action TEXT NOT NULL,
         target_id INTEGER,
         user_name TEXT,
@@ -80,79 +85,364 @@ INIT_SQL = [
         token_count INTEGER NOT NULL DEFAULT 0,
         updated_at INTEGER NOT NULL,
         PRIMARY KEY (user_id, model_name)
-    )
+    ) WITHOUT ROWID
     """,
-    "CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)",
-    "CREATE INDEX IF NOT EXISTS idx_usage_user ON usage(user_id)",
-    "CREATE INDEX IF NOT EXISTS idx_invitation_status ON invitation_codes(status)",
-    "CREATE INDEX IF NOT EXISTS idx_chat_history_chat ON chat_history(chat_id, seq)",
-    "CREATE INDEX IF NOT EXISTS idx_system_logs_ts ON system_logs(ts)",
-    "CREATE INDEX IF NOT EXISTS idx_usage_totals_user ON usage_totals(user_id)"
+    # 按 list_users 的排序建覆盖索引，顺带服务 role='super_admin' 的查询
+    "DROP INDEX IF EXISTS idx_users_role",
+    "CREATE INDEX IF NOT EXISTS idx_users_list ON users(role DESC, user_id ASC, first_seen, display_name)",
+    # usage / usage_totals 的主键前缀已覆盖所有按 user_id 的查询，单列索引多余
+    "DROP INDEX IF EXISTS idx_usage_user",
+    "DROP INDEX IF EXISTS idx_usage_totals_user",
+    # 只收录未使用的邀请码，并按 list_invitation_codes 的排序覆盖其查询列（status 列是为了让规划器走覆盖索引）
+    "DROP INDEX IF EXISTS idx_invitation_status",
+    "CREATE INDEX IF NOT EXISTS idx_invitation_active ON invitation_codes(created_at DESC, code, role, status) WHERE status='active'",
+    # 覆盖索引：load_chat_history 只读索引即可，无需回表
+    "DROP INDEX IF EXISTS idx_chat_history_chat",
+    "CREATE INDEX IF NOT EXISTS idx_chat_history_cover ON chat_history(chat_id, seq, msg_uuid, role, content, ts)",
+    "CREATE INDEX IF NOT EXISTS idx_system_logs_ts ON system_logs(ts)"
 ]
+INIT_SQL_SCRIPT = ";\n".join(INIT_SQL) + ";"
+
+# 热点语句：统一成模块常量，配合连接的语句缓存复用已编译的执行计划
+_SQL_GET_USER = "SELECT * FROM users WHERE user_id=?"
+_SQL_GET_PROMPT = "SELECT system_prompt FROM settings WHERE user_id=? AND chat_type=?"
+_SQL_GET_USER_MODEL = "SELECT model_name FROM user_model_prefs WHERE user_id=?"
+_SQL_GET_USAGE = "SELECT count FROM usage WHERE user_id=? AND scope=? AND key=?"
+_SQL_SET_USAGE = """
+    INSERT INTO usage (user_id, scope, key, count)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, scope, key) DO UPDATE SET count=excluded.count
+"""
+_SQL_INCR_USAGE = """
+    INSERT INTO usage_totals (user_id, model_name, msg_count, token_count, updated_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, model_name) DO UPDATE SET
+      msg_count = msg_count + excluded.msg_count,
+      token_count = token_count + excluded.token_count,
+      updated_at = excluded.updated_at
+"""
+_SQL_LOAD_CHAT_HISTORY = "SELECT msg_uuid, role, content, ts FROM chat_history WHERE chat_id=? ORDER BY seq ASC"
+_SQL_UPSERT_USER = """
+    INSERT INTO users (user_id, role, first_seen, display_name)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET role=excluded.role, display_name=excluded.display_name
+"""
+
+# 旧库中以 TEXT 存储的时间列，启动时一次性迁移为 INTEGER (unix 秒)
+_TS_COLUMNS = {
+    "chat_history": ("ts",),
+    "system_logs": ("ts",),
+    "invitation_codes": ("created_at", "used_at"),
+}
+
+# 复合主键的小表改为 WITHOUT ROWID，数据直接存放在主键 B 树中
+_WITHOUT_ROWID_TABLES = ("settings", "usage", "usage_totals")
+
+User = namedtuple("User", "user_id role first_seen display_name")
+
+_MISSING = object()
+
+# (unix 秒, 格式化字符串)，按秒缓存，避免每次写库都走 strftime
+_now_cache = [(0, "")]
+
+
+def _now_str():
+    t = int(time.time())
+    cached = _now_cache[0]
+    if cached[0] == t:
+        return cached[1]
+    tm = time.localtime(t)
+    s = (f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d} "
+         f"{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}")
+    _now_cache[0] = (t, s)
+    return s
+
+
+class _LRUCache:
+    """线程安全的小型 LRU 缓存，供热点读路径使用"""
+
+    def __init__(self, maxsize=4096):
+        self._data = OrderedDict()
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        # 失效代数：每次 pop 递增，记下该 key 最近一次失效时的代数
+        self._gen = 0
+        self._invalidated = OrderedDict()
+        # 被淘汰出 _invalidated 的记录里最大的代数，早于它开始的读取一律不回填
+        self._gen_floor = 0
+
+    def get(self, key, default=_MISSING):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def token(self):
+        """读库前取一个代数，回填时交给 set 判断期间是否发生过失效"""
+        with self._lock:
+            return self._gen
+
+    def set(self, key, value, token):
+        with self._lock:
+            # 读库期间该 key 被写入方失效过，读到的可能是旧值，不回填
+            if token < self._gen_floor or self._invalidated.get(key, 0) > token:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._gen += 1
+            self._invalidated[key] = self._gen
+            self._invalidated.move_to_end(key)
+            if len(self._invalidated) > self._maxsize:
+                _, gen = self._invalidated.popitem(last=False)
+                self._gen_floor = max(self._gen_floor, gen)
+
 
 class Database:
-    def __init__(self, db_path):
+    READ_POOL_SIZE = 4
+    CACHED_STATEMENTS = 256
+    USAGE_FLUSH_INTERVAL = 5
+    USAGE_FLUSH_THRESHOLD = 200
+    MMAP_SIZE = 1073741824  # 1 GiB，足以映射整个库文件
+    CACHE_SIZE_KIB = 131072  # 128 MiB 页缓存
+
+    def __init__(self, db_path, read_pool_size=None):
         self._lock = threading.RLock()
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+        # 当前持锁线程的事务嵌套层数，只在持有 self._lock 时读写
+        self._tx_depth = 0
+        self._tx_invalidations = []
+        self.db_path = db_path
+        # 读缓存：写入时同步失效
+        self._user_cache = _LRUCache()
+        self._prompt_cache = _LRUCache()
+        self._model_cache = _LRUCache()
+        # 写连接：所有写操作都经由 self._lock 串行化
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=self.CACHED_STATEMENTS)
+        self._apply_pragmas(self.conn)
         self._init_db()
+        # 只读连接池：WAL 模式下读不阻塞写，也不互相阻塞
+        self._read_pool = queue.Queue()
+        self._read_conns = []
+        # 由 pathlib 生成并转义 file: URI，路径里的 ?、#、% 等字符不会被当成 URI 语法
+        read_uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+        for _ in range(read_pool_size or self.READ_POOL_SIZE):
+            rconn = sqlite3.connect(
+                read_uri, uri=True, check_same_thread=False,
+                cached_statements=self.CACHED_STATEMENTS
+            )
+            self._apply_read_pragmas(rconn)
+            self._read_conns.append(rconn)
+            self._read_pool.put(rconn)
+        # usage_totals 写缓冲：(user_id, model_name) -> [msg_delta, token_delta, ts]
+        self._usage_buf = {}
+        self._usage_buf_events = 0
+        self._usage_buf_lock = threading.Lock()
+        self._closing = threading.Event()
+        self._usage_flusher = threading.Thread(target=self._usage_flush_worker, daemon=True)
+        self._usage_flusher.start()
+
+    def _apply_pragmas(self, conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._apply_read_pragmas(conn)
+
+    def _apply_read_pragmas(self, conn):
+        # mmap_size / cache_size 是连接级设置，读写连接都需要单独设置
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(f"PRAGMA cache_size=-{self.CACHE_SIZE_KIB}")
+        conn.execute("PRAGMA busy_timeout=5000")
+        actual = conn.execute(f"PRAGMA mmap_size={self.MMAP_SIZE}").fetchone()
+        if actual is not None and actual[0] < self.MMAP_SIZE:
+            print(f"[DB] mmap_size 被限制为 {actual[0]} 字节 (请求 {self.MMAP_SIZE})")
 
     def _init_db(self):
         with self._lock:
-            cur = self.conn.cursor()
-            for stmt in INIT_SQL:
-                cur.execute(stmt)
+            self.conn.executescript(INIT_SQL_SCRIPT)
+            self.conn.commit()
+            migrated = self._migrate_ts_columns()
+            migrated = self._migrate_without_rowid() or migrated
+            if migrated:
+                # 重建表时索引随旧表一起删除，这里补建
+                self.conn.executescript(INIT_SQL_SCRIPT)
+
+    def _rebuild_table(self, table, select_exprs=None):
+        """按 INIT_SQL 中的最新定义重建表并拷回数据；select_exprs 可覆盖个别列的取值表达式"""
+        create_sql = next(stmt for stmt in INIT_SQL if f"CREATE TABLE IF NOT EXISTS {table} " in stmt)
+        # PRAGMA table_info 列顺序: cid, name, type, notnull, dflt_value, pk
+        cols = [r[1] for r in self.conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        select_exprs = select_exprs or {}
+        select_cols = [select_exprs.get(c, c) for c in cols]
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+            self.conn.execute(create_sql)
+            # WITHOUT ROWID 表的主键列强制 NOT NULL，旧表中的脏行直接丢弃
+            self.conn.execute(
+                f"INSERT OR IGNORE INTO {table} ({', '.join(cols)}) "
+                f"SELECT {', '.join(select_cols)} FROM {table}_old"
+            )
+            self.conn.execute(f"DROP TABLE {table}_old")
             self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _migrate_ts_columns(self):
+        migrated = False
+        for table, ts_cols in _TS_COLUMNS.items():
+            info = self.conn.execute(f"PRAGMA table_info({table})").fetchall()
+            types = {r[1]: (r[2] or "").upper() for r in info}
+            if all(types.get(c) == "INTEGER" for c in ts_cols):
+                continue
+            self._rebuild_table(table, {
+                c: f"COALESCE(CAST(strftime('%s', {c}, 'utc') AS INTEGER), {c})" for c in ts_cols
+            })
+            print(f"[DB] 已将 {table} 的时间列迁移为 INTEGER")
+            migrated = True
+        return migrated
+
+    def _migrate_without_rowid(self):
+        migrated = False
+        for table in _WITHOUT_ROWID_TABLES:
+            row = self.conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+            if not row or "WITHOUT ROWID" in row[0].upper():
+                continue
+            self._rebuild_table(table)
+            print(f"[DB] 已将 {table} 重建为 WITHOUT ROWID 表")
+            migrated = True
+        return migrated
 
     def close(self):
+        self._closing.set()
+        self._usage_flusher.join(timeout=5)
+        self.flush_usage()
         with self._lock:
+            for rconn in self._read_conns:
+                rconn.close()
+            self._read_conns = []
             self.conn.close()
 
+    @contextmanager
+    def transaction(self):
+        """持有写锁执行一组写操作，最外层结束时统一提交一次；可嵌套"""
+        with self._lock:
+            depth = self._tx_depth
+            if depth == 0:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._tx_depth = depth + 1
+            try:
+                yield self.conn
+            except BaseException:
+                self._tx_depth = depth
+                if depth == 0:
+                    self._tx_invalidations = []
+                    self.conn.rollback()
+                raise
+            self._tx_depth = depth
+            if depth == 0:
+                self.conn.commit()
+                # 事务期间其他线程可能把提交前的旧值读回缓存，提交后再失效一次
+                pending, self._tx_invalidations = self._tx_invalidations, []
+                for cache, key in pending:
+                    cache.pop(key)
+
+    def _invalidate(self, cache, key):
+        cache.pop(key)
+        if self._tx_depth:
+            self._tx_invalidations.append((cache, key))
+
     def execute(self, sql, params=()):
         with self._lock:
-            cur = self.conn.cursor()
-            cur.execute(sql, params)
-            self.conn.commit()
+            cur = self.conn.execute(sql, params)
+            if self._tx_depth == 0:
+                self.conn.commit()
             return cur
 
-    def query_one(self, sql, params=()):
-        with self._lock:
-            cur = self.conn.cursor()
-            cur.execute(sql, params)
+    def query_one(self, sql, params=(), row_factory=None):
+        rconn = self._read_pool.get()
+        try:
+            cur = rconn.execute(sql, params)
+            cur.row_factory = row_factory
             return cur.fetchone()
+        finally:
+            self._read_pool.put(rconn)
 
-    def query_all(self, sql, params=()):
-        with self._lock:
-            cur = self.conn.cursor()
-            cur.execute(sql, params)
+    def query_all(self, sql, params=(), row_factory=None):
+        rconn = self._read_pool.get()
+        try:
+            cur = rconn.execute(sql, params)
+            cur.row_factory = row_factory
             return cur.fetchall()
+        finally:
+            self._read_pool.put(rconn)
+
+    def query_iter(self, sql, params=(), row_factory=None, batch_size=256):
+        """逐批 yield 结果行，不整体物化"""
+        rconn = self._read_pool.get()
+        try:
+            cur = rconn.execute(sql, params)
+            cur.row_factory = row_factory
+            while True:
+                batch = cur.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            self._read_pool.put(rconn)
 
     # Users
     def get_user(self, user_id):
-        return self.query_one("SELECT * FROM users WHERE user_id=?", (user_id,))
+        cached = self._user_cache.get(user_id)
+        if cached is not _MISSING:
+            return cached
+        token = self._user_cache.token()
+        row = self.query_one(_SQL_GET_USER, (user_id,))
+        user = User(*row) if row else None
+        self._user_cache.set(user_id, user, token)
+        return user
 
     def upsert_user(self, user_id, role, display_name=None):
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.execute(
-            """
-            INSERT INTO users (user_id, role, first_seen, display_name)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET role=excluded.role, display_name=excluded.display_name
-            """,
-            (user_id, role, now, display_name)
-        )
-
-    def update_display_name(self, user_id, display_name):
-        self.execute("UPDATE users SET display_name=? WHERE user_id=?", (display_name, user_id))
+        self.execute(_SQL_UPSERT_USER, (user_id, role, _now_str(), display_name))
+        self._invalidate(self._user_cache, user_id)
+
+    def upsert_users(self, rows):
+        """批量写入 (user_id, role, display_name)，单次 executemany"""
+        now = _now_str()
+        with self.transaction() as conn:
+            conn.executemany(_SQL_UPSERT_USER, [(uid, role, now, name) for uid, role, name in rows])
+            for uid, _, _ in rows:
+                self._invalidate(self._user_cache, uid)
+
+    def update_display_names(self, rows):
+        """批量更新 (user_id, display_name)"""
+        with self.transaction() as conn:
+            conn.executemany("UPDATE users SET display_name=? WHERE user_id=?", [(name, uid) for uid, name in rows])
+            for uid, _ in rows:
+                self._invalidate(self._user_cache, uid)
 
     def delete_user(self, user_id):
         self.execute("DELETE FROM users WHERE user_id=?", (user_id,))
+        self._invalidate(self._user_cache, user_id)
+
+    def delete_users(self, user_ids):
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM users WHERE user_id=?", [(uid,) for uid in user_ids])
+            for uid in user_ids:
+                self._invalidate(self._user_cache, uid)
 
     def list_users(self):
-        return self.query_all("SELECT * FROM users ORDER BY role DESC, user_id ASC")
+        return self.query_all("SELECT * FROM users ORDER BY role DESC, user_id ASC", row_factory=sqlite3.Row)
+    def list_user_roles(self):
+        return self.query_all("SELECT user_id, role FROM users")
     def list_super_admin_ids(self):
         rows = self.query_all("SELECT user_id FROM users WHERE role='super_admin'")
-        return [r["user_id"] for r in rows]
+        return [r[0] for r in rows]
 
 
     # Settings
@@ -168,25 +458,35 @@ class Database:
                 """,
                 (user_id, chat_type, prompt)
             )
+        self._invalidate(self._prompt_cache, (user_id, chat_type))
 
     def get_prompt(self, user_id, chat_type):
-        row = self.query_one(
-            "SELECT system_prompt FROM settings WHERE user_id=? AND chat_type=?",
-            (user_id, chat_type)
-        )
-        return row["system_prompt"] if row else None
+        key = (user_id, chat_type)
+        cached = self._prompt_cache.get(key)
+        if cached is not _MISSING:
+            return cached
+        token = self._prompt_cache.token()
+        row = self.query_one(_SQL_GET_PROMPT, (user_id, chat_type))
+        prompt = row[0] if row else None
+        self._prompt_cache.set(key, prompt, token)
+        return prompt
     
     # === 新增：模型偏好 (Model Preferences) ===
     def get_user_model(self, user_id):
-        row = self.query_one("SELECT model_name FROM user_model_prefs WHERE user_id=?", (user_id,))
-        if row and row["model_name"]:
-            return row["model_name"].strip()
-        return None
+        cached = self._model_cache.get(user_id)
+        if cached is not _MISSING:
+            return cached
+        token = self._model_cache.token()
+        row = self.query_one(_SQL_GET_USER_MODEL, (user_id,))
+        model_name = row[0].strip() if row and row[0] else None
+        self._model_cache.set(user_id, model_name, token)
+        return model_name
 
     def set_user_model(self, user_id, model_name):
         try:
             if model_name is None or not str(model_name).strip():
                 self.execute("DELETE FROM user_model_prefs WHERE user_id=?", (user_id,))
+                self._invalidate(self._model_cache, user_id)
                 return True
             model_name = str(model_name).strip()
             self.execute(
@@ -196,6 +496,7 @@ class Database:
                 """,
                 (user_id, model_name)
             )
+            self._invalidate(self._model_cache, user_id)
             return True
         except Exception as e:
             print(f"[DB Error] set_user_model: {e}")
@@ -204,63 +505,85 @@ class Database:
 
     # Usage
     def get_usage(self, user_id, scope, key):
-        row = self.query_one(
-            "SELECT count FROM usage WHERE user_id=? AND scope=? AND key=?",
-            (user_id, scope, key)
-        )
-        return row["count"] if row else 0
+        row = self.query_one(_SQL_GET_USAGE, (user_id, scope, key))
+        return row[0] if row else 0
 
     def set_usage(self, user_id, scope, key, count):
-        self.execute(
-            """
-            INSERT INTO usage (user_id, scope, key, count)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id, scope, key) DO UPDATE SET count=excluded.count
-            """,
-            (user_id, scope, key, count)
-        )
+        self.execute(_SQL_SET_USAGE, (user_id, scope, key, count))
 
-    def cleanup_usage(self, user_id, scope, valid_keys):
-        if not valid_keys:
-            self.execute("DELETE FROM usage WHERE user_id=? AND scope=?", (user_id, scope))
-            return
-        placeholders = ",".join("?" for _ in valid_keys)
-        params = (user_id, scope, *valid_keys)
+    def cleanup_usage_all(self, scope, valid_keys):
+        """一次清理所有用户在 scope 下不在 valid_keys 中的计数"""
         self.execute(
-            f"DELETE FROM usage WHERE user_id=? AND scope=? AND key NOT IN ({placeholders})",
-            params
+            "DELETE FROM usage WHERE scope=? AND key NOT IN (SELECT value FROM json_each(?))",
+            (scope, json.dumps(list(valid_keys)))
         )
 
     # === 新增：usage_totals 统计 ===
     def incr_usage(self, user_id, model_name, msg_delta, token_delta, ts):
-        self.execute(
-            """
-            INSERT INTO usage_totals (user_id, model_name, msg_count, token_count, updated_at)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(user_id, model_name) DO UPDATE SET
-              msg_count = msg_count + excluded.msg_count,
-              token_count = token_count + excluded.token_count,
-              updated_at = excluded.updated_at
-            """,
-            (user_id, model_name, msg_delta, token_delta, ts)
-        )
+        key = (user_id, model_name)
+        with self._usage_buf_lock:
+            entry = self._usage_buf.get(key)
+            if entry is None:
+                self._usage_buf[key] = [msg_delta, token_delta, ts]
+            else:
+                entry[0] += msg_delta
+                entry[1] += token_delta
+                entry[2] = max(entry[2], ts)
+            self._usage_buf_events += 1
+            should_flush = self._usage_buf_events >= self.USAGE_FLUSH_THRESHOLD
+        if should_flush:
+            self.flush_usage()
+
+    def flush_usage(self):
+        with self._usage_buf_lock:
+            if not self._usage_buf:
+                return
+            buf = self._usage_buf
+            self._usage_buf = {}
+            self._usage_buf_events = 0
+        rows = [(uid, model, m, t, ts) for (uid, model), (m, t, ts) in buf.items()]
+        try:
+            with self.transaction() as conn:
+                conn.executemany(_SQL_INCR_USAGE, rows)
+        except Exception:
+            # 写库失败时把增量并回缓冲区，留给下次 flush，避免计数丢失
+            with self._usage_buf_lock:
+                for key, (m, t, ts) in buf.items():
+                    entry = self._usage_buf.get(key)
+                    if entry is None:
+                        self._usage_buf[key] = [m, t, ts]
+                    else:
+                        entry[0] += m
+                        entry[1] += t
+                        entry[2] = max(entry[2], ts)
+                self._usage_buf_events += len(buf)
+            raise
+
+    def _usage_flush_worker(self):
+        while not self._closing.wait(timeout=self.USAGE_FLUSH_INTERVAL):
+            try:
+                self.flush_usage()
+            except Exception as e:
+                print(f"[DB Error] flush_usage: {e}")
 
     def get_usage_totals(self, user_id):
+        self.flush_usage()
         return self.query_all(
             "SELECT model_name, msg_count, token_count FROM usage_totals WHERE user_id = ?",
-            (user_id,)
+            (user_id,), row_factory=sqlite3.Row
         )
 
     def get_usage_total_all_models(self, user_id):
+        self.flush_usage()
         row = self.query_one(
-            "SELECT SUM(msg_count) AS msg_count, SUM(token_count) AS token_count FROM usage_totals WHERE user_id = ?",
+            "SELECT SUM(msg_count), SUM(token_count) FROM usage_totals WHERE user_id = ?",
             (user_id,)
         )
-        return (row["msg_count"], row["token_count"]) if row else (0, 0)
+        return (row[0] or 0, row[1] or 0) if row else (0, 0)
 
     # Invitation codes
     def create_invitation_code(self, code, role, created_by):
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now = int(time.time())
         self.execute(
             """
             INSERT INTO invitation_codes (code, role, created_at, created_by, status)
@@ -270,10 +593,9 @@ class Database:
         )
 
     def consume_invitation_code(self, code, used_by):
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with self._lock:
-            cur = self.conn.cursor()
-            cur.execute(
+        now = int(time.time())
+        with self.transaction() as conn:
+            row = conn.execute(
                 """
                 UPDATE invitation_codes
                 SET status='used', used_at=?, used_by=?
@@ -281,15 +603,18 @@ class Database:
                 RETURNING role
                 """,
                 (now, used_by, code)
-            )
-            row = cur.fetchone()
-            self.conn.commit()
-            return row["role"] if row else None
+            ).fetchone()
+        return row[0] if row else None
+
 
+    def list_invitation_code_values(self):
+        """全部邀请码（含已使用/已作废），用于生成新码时查重"""
+        return [r[0] for r in self.query_iter("SELECT code FROM invitation_codes")]
 
     def list_invitation_codes(self):
         return self.query_all(
-            "SELECT code, role, created_at FROM invitation_codes WHERE status='active' ORDER BY created_at DESC"
+            "SELECT code, role, created_at FROM invitation_codes WHERE status='active' ORDER BY created_at DESC",
+            row_factory=sqlite3.Row
         )
 
     def revoke_invitation_code(self, code):
@@ -301,36 +626,49 @@ class Database:
 
     # Chat history
     def load_chat_history(self, chat_id):
-        rows = self.query_all(
-            "SELECT msg_uuid, role, content, ts FROM chat_history WHERE chat_id=? ORDER BY seq ASC",
-            (chat_id,)
-        )
-        return [{"uuid": r["msg_uuid"], "role": r["role"], "content": r["content"], "ts": r["ts"]} for r in rows]
+        rows = self.query_iter(_SQL_LOAD_CHAT_HISTORY, (chat_id,))
+        return [{"uuid": u, "role": r, "content": c, "ts": t} for (u, r, c, t) in rows]
 
     def save_chat_history(self, chat_id, context):
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with self._lock:
-            cur = self.conn.cursor()
-            try:
-                cur.execute("BEGIN")
-                cur.execute("DELETE FROM chat_history WHERE chat_id=?", (chat_id,))
-                for idx, msg in enumerate(context):
-                    cur.execute(
-                        """
-                        INSERT INTO chat_history (chat_id, msg_uuid, role, content, ts, seq)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                        """,
-                        (chat_id, msg.get("uuid"), msg["role"], msg["content"], msg.get("ts", now), idx)
-                    )
-                self.conn.commit()
-            except Exception:
-                self.conn.rollback()
-                raise
+        now = int(time.time())
+        with self.transaction() as conn:
+            row = conn.execute(
+                """
+                SELECT COUNT(*) AS cnt,
+                       (SELECT msg_uuid FROM chat_history WHERE chat_id=? ORDER BY seq ASC LIMIT 1) AS first_uuid,
+                       (SELECT msg_uuid FROM chat_history WHERE chat_id=? ORDER BY seq DESC LIMIT 1) AS last_uuid
+                FROM chat_history WHERE chat_id=?
+                """,
+                (chat_id, chat_id, chat_id)
+            ).fetchone()
+            count, first_uuid, last_uuid = row
+            # 常见情况：只在末尾追加了消息，已落库部分首尾 uuid 一致时只插入新增行
+            append_only = (
+                0 < count <= len(context)
+                and first_uuid is not None
+                and context[0].get("uuid") == first_uuid
+                and context[count - 1].get("uuid") == last_uuid
+            )
+            if not append_only:
+                conn.execute("DELETE FROM chat_history WHERE chat_id=?", (chat_id,))
+                count = 0
+            rows = [
+                (chat_id, msg.get("uuid"), msg["role"], msg["content"], msg.get("ts", now), idx)
+                for idx, msg in enumerate(context[count:], start=count)
+            ]
+            if rows:
+                conn.executemany(
+                    """
+                    INSERT INTO chat_history (chat_id, msg_uuid, role, content, ts, seq)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    rows
+                )
 
 
     # System logs
     def add_system_log(self, action, target_id=None, user_name=None, source=None, detail=None):
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now = int(time.time())
         self.execute(
             """
             INSERT INTO system_logs (ts, action, target_id, user_name, source, detail)
@@ -339,9 +677,27 @@ class Database:
             (now, action, target_id, user_name, source, detail)
         )
 
-    def get_recent_logs(self, limit=10):
-        rows = self.query_all(
-            "SELECT ts, action, target_id, user_name, source FROM system_logs ORDER BY id DESC LIMIT ?",
+    def add_system_logs_bulk(self, rows):
+        """批量写日志，rows 为 (action, target_id, user_name, source, detail) 元组"""
+        now = int(time.time())
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO system_logs (ts, action, target_id, user_name, source, detail) VALUES (?, ?, ?, ?, ?, ?)",
+                [(now, *row) for row in rows]
+            )
+
+    def get_recent_logs_with_names(self, limit=10):
+        """最近的系统日志，并在 SQL 中关联 users 取当前 display_name（用户不存在时为 None）"""
+        rows = self.query_iter(
+            """
+            SELECT l.ts, l.action, l.target_id, l.user_name, l.source, u.display_name
+            FROM system_logs l LEFT JOIN users u ON u.user_id = l.target_id
+            ORDER BY l.id DESC LIMIT ?
+            """,
             (limit,)
         )
-        return rows
+        return [
+            {"ts": ts, "action": action, "target_id": target_id, "user_name": user_name,
+             "source": source, "display_name": display_name}
+            for (ts, action, target_id, user_name, source, display_name) in rows
+        ]
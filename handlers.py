@@ -1,12 +1,76 @@
 # handlers.py
 import uuid
+import time
 import datetime
+_MD_ESCAPE_CHARS = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+_MD_ESCAPE_TABLE = str.maketrans({c: f'\\{c}' for c in _MD_ESCAPE_CHARS})
+
 def escape_md(text):
-    if not text: return ""
-    chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for c in chars:
-        text = text.replace(c, f'\\{c}')
-    return text
+    return text.translate(_MD_ESCAPE_TABLE) if text else ""
+
+_VALID_INVITE_ROLES = frozenset(("user", "admin"))
+_GROUP_CHAT_TYPES = frozenset(("group", "supergroup"))
+
+# /help 的各角色文本在导入时拼好，按角色直接选用
+_HELP_LOCKED = "🔒 *Bot 访问受限*\n\n此Bot仅限授权用户使用。\n\n🔑 如果你有邀请码，请使用：\n`/auth 邀请码`"
+
+_HELP_USER = """📚 *指令帮助菜单*
+
+*⚠️ 除 /clear 外，所有指令只能在私聊中使用*
+
+*👤 常用指令*
+
+`/sp` 设置私聊时AI的性格。
+用 `/sp reset` 恢复默认。
+例: `/sp 你是一只猫娘`
+
+`/sg` 设置群聊时AI的性格。
+用 `/sg reset` 恢复默认。
+例: `/sg 你是群里的吉祥物`
+
+`/clear`
+清空当前对话的记忆（群组中仅管理员可用）
+
+`/usage`
+查看今日/本小时使用次数
+
+`/model`
+查看或切换 AI 模型/线路
+
+`/sys`
+查看当前生效的系统提示词
+"""
+
+_HELP_ADMIN = _HELP_USER + """
+*👮 管理员指令*
+
+`/add` 用户ID
+添加白名单。也可回复某人消息直接使用 `/add`
+
+`/del` 用户ID  
+移除白名单。
+
+`/recent_users`
+查看最近加入白名单的日志
+
+`/temp` 温度值
+调整AI温度（0.0-2.0）
+"""
+
+_HELP_SUPER = _HELP_ADMIN + """
+*👑 超级管理员指令*
+
+`/gc user` 生成普通用户一次性邀请码
+`/gc admin` 生成管理员一次性邀请码
+
+`/gl user` 生成普通用户一次性邀请链接
+`/gl admin` 生成管理员一次性邀请链接
+
+`/lc` 查看所有未使用的一次性邀请码
+`/rmc 邀请码` 撤销一个未使用的邀请码
+
+`/add_admin` 用户ID 直接添加管理员
+"""
 
 def register_handlers(
     bot,
@@ -29,10 +93,37 @@ def register_handlers(
     get_context_slice_for_reply,
     insert_ai_reply,
 ):
-    def core_reply_cycle(chat_id, user_id, message_to_reply, user_msg_uuid):
+    # 模型描述来自静态配置，注册时一次性转义
+    _escaped_desc = {p['name']: escape_md(p.get('description', p['name'])) for p in cfg.AI_PROVIDERS}
+
+    # 按 (user_id, chat_type) 复用 system 消息对象，提示词未变时请求前缀保持完全一致
+    _sys_msg_cache = {}
+
+    def _system_message(user_id, chat_type, content):
+        key = (user_id, chat_type)
+        cached = _sys_msg_cache.get(key)
+        if cached is None or cached["content"] != content:
+            cached = {"role": "system", "content": content}
+            _sys_msg_cache[key] = cached
+        return cached
+
+    # 线路熔断：调用失败的线路在冷却期内直接跳过，全部处于冷却时仍按原顺序兜底尝试
+    _PROVIDER_COOLDOWN = 30  # 秒
+    _provider_fail_until = {}
+    # 日志里的 "Bot(线路名)" 每条线路只拼一次，回复时直接复用同一个字符串
+    _bot_log_roles = {name: f"Bot({name})" for name in provider_manager.provider_list}
+
+    def _ordered_service_chain(user_id):
+        now = time.monotonic()
+        chain = list(provider_manager.get_service_chain(user_id))
+        healthy = [item for item in chain if now >= _provider_fail_until.get(item[0], 0)]
+        return healthy or chain
+
+    def core_reply_cycle(chat_id, user_id, message_to_reply, user_msg_uuid, chat_lock=None, api_context=None):
         chat_id_str = str(chat_id)
         chat_type = message_to_reply.chat.type
-        chat_lock = chat_locks.get_lock(chat_id_str)
+        if chat_lock is None:
+            chat_lock = chat_locks.get_lock(chat_id_str)
 
         prompt_type, user_prompt, base_prompt, extra_prompt, user_system_prompt = build_effective_system_prompt(
             settings_manager, cfg, user_id, chat_type
@@ -46,14 +137,14 @@ def register_handlers(
         error_log = []
 
         try:
-            with chat_lock:
-                api_context = get_context_slice_for_reply(context_manager, chat_id_str, user_msg_uuid)
-                api_context = [{"role": m["role"], "content": m["content"]} for m in api_context]
-                messages_payload = [{"role": "system", "content": user_system_prompt}] + api_context
+            if api_context is None:
+                with chat_lock:
+                    api_context = get_context_slice_for_reply(context_manager, chat_id_str, user_msg_uuid)
+            messages_payload = [_system_message(user_id, prompt_type, user_system_prompt), *api_context]
 
-            for p_name, service in provider_manager.get_service_chain(user_id):
+            for p_name, service in _ordered_service_chain(user_id):
                 try:
-                    temp = service.config.DEFAULT_TEMP
+                    temp = service.default_temp
                     result = service.get_chat_response(messages_payload, temp)
 
                     if isinstance(result, tuple) and len(result) == 2:
@@ -66,15 +157,18 @@ def register_handlers(
 
                     if ai_reply:
                         success_provider = p_name
+                        _provider_fail_until.pop(p_name, None)
                         break
                 except Exception as e:
-                    err_msg = str(e)
-                    print(f"[Failover] User:{user_id} | Provider:{p_name} 失败: {err_msg}")
-                    error_log.append(f"{p_name}: {err_msg[:50]}...")
+                    _provider_fail_until[p_name] = time.monotonic() + _PROVIDER_COOLDOWN
+                    error_log.append((p_name, e))
                     continue
 
+            # 失败信息只在确实发生切换时才格式化
+            if error_log:
+                print(f"[Failover] User:{user_id} | " + "; ".join(f"Provider:{n} 失败: {e}" for n, e in error_log))
             if not ai_reply:
-                raise Exception(f"所有线路均失败: {'; '.join(error_log)}")
+                raise Exception("所有线路均失败: " + "; ".join(f"{n}: {str(e)[:50]}..." for n, e in error_log))
 
             sent = False
             try:
@@ -88,9 +182,9 @@ def register_handlers(
                 ai_msg_obj = {
                     "role": "assistant",
                     "content": ai_reply,
-                    "uuid": str(uuid.uuid4()),
+                    "uuid": uuid.uuid4().hex,
                     "reply_to": user_msg_uuid,
-                    "ts": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "ts": int(time.time()),
                     "model": success_provider
                 }
                 with chat_lock:
@@ -98,7 +192,7 @@ def register_handlers(
 
                 if chat_type == 'private':
                     display_name = auth_manager.get_display_name(message_to_reply.from_user)
-                    async_logger.log(user_id, display_name, f"Bot({success_provider})", ai_reply)
+                    async_logger.log(user_id, display_name, _bot_log_roles[success_provider], ai_reply)
 
                 token_delta = 0
                 if usage:
@@ -113,40 +207,51 @@ def register_handlers(
             except Exception:
                 pass
 
-    def private_only(func):
-        def wrapper(message):
-            if message.chat.type != 'private':
-                bot_helper.send_cmd_reply(message, "⚠️ 此指令只能在私聊中使用。")
-                return
-            return func(message)
-        return wrapper
-    
-    def require_whitelist(func):
-        def wrapper(message):
-            if not auth_manager.is_whitelisted(message.from_user.id):
-                return
-            return func(message)
-        return wrapper
-
-    def require_admin(func):
-        def wrapper(message):
-            if not auth_manager.is_admin(message.from_user.id):
-                return
-            return func(message)
-        return wrapper
-
-    def require_super_admin(func):
-        def wrapper(message):
-            if not auth_manager.is_super_admin(message.from_user.id):
-                return
-            return func(message)
-        return wrapper
+    def guarded(private=False, role=None):
+        """合并私聊限制与角色校验，每次调用只多一层函数帧"""
+        # 集合在用户增删时整体替换，这里只记属性名，调用时再取
+        ids_attr = {
+            None: None,
+            "whitelist": "whitelist_ids",
+            "admin": "admin_ids",
+            "super_admin": "super_admin_ids",
+        }[role]
+
+        def decorator(func):
+            def wrapper(message):
+                if private and message.chat.type != 'private':
+                    bot_helper.send_cmd_reply(message, "⚠️ 此指令只能在私聊中使用。")
+                    return
+                if ids_attr is not None and message.from_user.id not in getattr(auth_manager, ids_attr):
+                    return
+                return func(message)
+            return wrapper
+        return decorator
+
+    # Bot 用户名基本不变，首次用到时取一次并缓存 (username, "@username")
+    _bot_identity = [None]
+
+    def _bot_identity_get():
+        identity = _bot_identity[0]
+        if identity is None:
+            username = bot_helper.get_username()
+            identity = (username, f"@{username}" if username else None)
+            _bot_identity[0] = identity
+        return identity
 
     def _get_chat_type(message):
         return "private" if message.chat.type == "private" else "group"
 
+    def _args(message):
+        """按空白切分指令文本，结果挂在 message 上，同一条消息只切一次"""
+        args = getattr(message, "_cached_args", None)
+        if args is None:
+            args = message.text.split()
+            message._cached_args = args
+        return args
+
     def _get_cmd_arg(message, idx, usage_text):
-        args = message.text.split()
+        args = _args(message)
         if len(args) <= idx:
             bot_helper.send_cmd_reply(message, usage_text, parse_mode="Markdown")
             return None
@@ -158,7 +263,7 @@ def register_handlers(
 
     def _handle_set_prompt(message, prompt_type, cmd_hint):
         user_id = message.from_user.id
-        cmd_used = message.text.split()[0]
+        cmd_used = _args(message)[0]
         prompt_text = message.text.replace(cmd_used, "").strip()
 
         if not prompt_text:
@@ -199,84 +304,30 @@ def register_handlers(
         return None, None
 
     @bot.message_handler(commands=['help'])
-    @private_only
+    @guarded(private=True)
     def cmd_help(message):
         chat_type = _get_chat_type(message)
         user_id = message.from_user.id
         if not auth_manager.can_use_chat(user_id, chat_type):
-            help_text = "🔒 *Bot 访问受限*\n\n此Bot仅限授权用户使用。"
-            help_text += "\n\n🔑 如果你有邀请码，请使用：\n`/auth 邀请码`"
-            bot_helper.send_cmd_reply(message, help_text, parse_mode="Markdown", preserve_reply=True)
+            bot_helper.send_cmd_reply(message, _HELP_LOCKED, parse_mode="Markdown", preserve_reply=True)
             return
 
-        help_text = """📚 *指令帮助菜单*
-
-*⚠️ 除 /clear 外，所有指令只能在私聊中使用*
-
-*👤 常用指令*
-
-`/sp` 设置私聊时AI的性格。
-用 `/sp reset` 恢复默认。
-例: `/sp 你是一只猫娘`
-
-`/sg` 设置群聊时AI的性格。
-用 `/sg reset` 恢复默认。
-例: `/sg 你是群里的吉祥物`
-
-`/clear`
-清空当前对话的记忆（群组中仅管理员可用）
-
-`/usage`
-查看今日/本小时使用次数
-
-`/model`
-查看或切换 AI 模型/线路
-
-`/sys`
-查看当前生效的系统提示词
-"""
-        if auth_manager.is_admin(user_id):
-            help_text += """
-*👮 管理员指令*
-
-`/add` 用户ID
-添加白名单。也可回复某人消息直接使用 `/add`
-
-`/del` 用户ID  
-移除白名单。
-
-`/recent_users`
-查看最近加入白名单的日志
-
-`/temp` 温度值
-调整AI温度（0.0-2.0）
-"""
         if auth_manager.is_super_admin(user_id):
-            help_text += """
-*👑 超级管理员指令*
-
-`/gc user` 生成普通用户一次性邀请码
-`/gc admin` 生成管理员一次性邀请码
-
-`/gl user` 生成普通用户一次性邀请链接
-`/gl admin` 生成管理员一次性邀请链接
-
-`/lc` 查看所有未使用的一次性邀请码
-`/rmc 邀请码` 撤销一个未使用的邀请码
-
-`/add_admin` 用户ID 直接添加管理员
-"""
+            help_text = _HELP_SUPER
+        elif auth_manager.is_admin(user_id):
+            help_text = _HELP_ADMIN
+        else:
+            help_text = _HELP_USER
         bot_helper.send_cmd_reply(message, help_text, parse_mode="Markdown", preserve_reply=True)
 
     @bot.message_handler(commands=['model', 'switch'])
-    @private_only
-    @require_whitelist
+    @guarded(private=True, role='whitelist')
     def cmd_switch_model(message):
         user_id = message.from_user.id
         # 1. 优化参数解析，支持带空格的模型名
         cmd_text = message.text.strip()
         args = cmd_text.split(maxsplit=1)
-        
+
         # 如果没有参数，显示列表
         if len(args) < 2:
             current = provider_manager.get_user_provider_name(user_id)
@@ -284,20 +335,11 @@ def register_handlers(
             # 使用列表构建，最后再一次性 join，性能更好
             lines = [f"🤖 *当前使用模型*: `{current}`", "", "*可用模型列表*:"]
             
-            for p in cfg.AI_PROVIDERS:
-                name = p['name']
-                # 获取描述，如果没有则用名字代替
-                raw_desc = p.get('description', name)
-                
-                # 【关键修复】对描述进行 Markdown 转义，防止 _ * 等符号导致不响应
-                # 注意：handlers.py 顶部必须有 escape_md 函数
-                safe_desc = escape_md(raw_desc)
-                
+            for name, safe_desc in _escaped_desc.items():
                 status = "✅" if name == current else "⚪️"
                 
                 # 检查是否实际加载
-                is_loaded = any(loaded_name.lower() == name.lower() for loaded_name in provider_manager.provider_list)
-                if not is_loaded:
+                if name not in provider_manager.services:
                     status = "❌(未加载)"
                 
                 lines.append(f"{status} `{name}` - {safe_desc}")
@@ -309,23 +351,12 @@ def register_handlers(
             return
 
         # 切换逻辑
-        input_name = args[1].strip().lower()
-        target_model = None
-        
-        for name in provider_manager.provider_list:
-            if name.lower() == input_name:
-                target_model = name
-                break
+        target_model = provider_manager.resolve_name(args[1])
         
         if target_model:
             if provider_manager.set_user_provider(user_id, target_model):
                 # 同样获取描述并转义
-                desc_str = target_model
-                for p in cfg.AI_PROVIDERS:
-                    if p['name'] == target_model:
-                        desc_str = p.get('description', target_model)
-                        break
-                safe_desc = escape_md(desc_str)
+                safe_desc = _escaped_desc.get(target_model, escape_md(target_model))
                 
                 bot_helper.send_cmd_reply(message, f"✅ 切换成功！\n现在使用: *{safe_desc}* (`{target_model}`)", parse_mode="Markdown")
             else:
@@ -335,11 +366,11 @@ def register_handlers(
 
 
     @bot.message_handler(commands=['start'])
-    @private_only
+    @guarded(private=True)
     def cmd_start(message):
         chat_type = _get_chat_type(message)
         user_id = message.from_user.id
-        args = message.text.split()
+        args = _args(message)
         welcome_text = f"👋 你好！我是 {cfg.DESCRIPTION}。"
 
         if auth_manager.can_use_chat(user_id, chat_type):
@@ -382,14 +413,14 @@ def register_handlers(
         bot_helper.send_cmd_reply(message, msg, parse_mode="Markdown")
 
     @bot.message_handler(commands=['auth'])
-    @private_only
+    @guarded(private=True)
     def cmd_auth(message):
         chat_type = _get_chat_type(message)
         user_id = message.from_user.id
         if auth_manager.can_use_chat(user_id, chat_type):
             bot_helper.send_cmd_reply(message, "✅ 你已经在白名单中，无需重复认证。")
             return
-        args = message.text.split()
+        args = _args(message)
         if len(args) < 2:
             bot_helper.send_cmd_reply(message, "⚠️ 请输入邀请码。用法: `/auth 邀请码`", parse_mode="Markdown")
             return
@@ -424,8 +455,7 @@ def register_handlers(
             bot_helper.send_cmd_reply(message, "❌ 邀请码错误或已被使用。")
 
     @bot.message_handler(commands=['sys'])
-    @private_only
-    @require_whitelist
+    @guarded(private=True, role='whitelist')
     def cmd_show_system_prompt(message):
         user_id = message.from_user.id
         
@@ -437,29 +467,20 @@ def register_handlers(
         # 确保你的 config.py 里确实有 DEFAULT_SYSTEM_PROMPT 这个变量
         default_val = cfg.DEFAULT_SYSTEM_PROMPT
 
-        parts = ["🧠 *当前系统提示词设定*"]
-
-        # --- 显示私聊设定 ---
-        parts.append("\n👤 *私聊模式 (/sp)*:")
-        if private_prompt:
-            parts.append(f"```\n{private_prompt}\n```")
-        else:
-            # 如果没设置，显示默认值
-            parts.append(f"(默认):\n```\n{default_val}\n```")
-
-        # --- 显示群聊设定 ---
-        parts.append("\n👥 *群聊模式 (/sg)*:")
-        if group_prompt:
-            parts.append(f"```\n{group_prompt}\n```")
-        else:
-            # 如果没设置，显示默认值
-            parts.append(f"(默认):\n```\n{default_val}\n```")
-            
-        bot_helper.send_cmd_reply(message, "\n".join(parts), parse_mode="Markdown", preserve_reply=True)
+        # 未设置时显示默认值
+        private_block = f"```\n{private_prompt}\n```" if private_prompt else f"(默认):\n```\n{default_val}\n```"
+        group_block = f"```\n{group_prompt}\n```" if group_prompt else f"(默认):\n```\n{default_val}\n```"
+        msg = "\n".join([
+            "🧠 *当前系统提示词设定*",
+            "\n👤 *私聊模式 (/sp)*:",
+            private_block,
+            "\n👥 *群聊模式 (/sg)*:",
+            group_block,
+        ])
+        bot_helper.send_cmd_reply(message, msg, parse_mode="Markdown", preserve_reply=True)
 
     @bot.message_handler(commands=['gc'])
-    @private_only
-    @require_super_admin
+    @guarded(private=True, role='super_admin')
     def cmd_gc(message):
         role_arg = _get_cmd_arg(
             message, 1,
@@ -468,7 +489,7 @@ def register_handlers(
             return
         role_arg = role_arg.lower()
 
-        if role_arg not in ["user", "admin"]:
+        if role_arg not in _VALID_INVITE_ROLES:
             bot_helper.send_cmd_reply(message, "❌ 权限类型必须是 `user` 或 `admin`", parse_mode="Markdown")
             return
         new_code = onetime_code_manager.generate_code(role_arg, message.from_user.id, cfg.ONETIME_CODE_LENGTH)
@@ -483,8 +504,7 @@ def register_handlers(
         )
 
     @bot.message_handler(commands=['gl'])
-    @private_only
-    @require_super_admin
+    @guarded(private=True, role='super_admin')
     def cmd_gl(message):
         role_arg = _get_cmd_arg(
             message, 1,
@@ -493,11 +513,11 @@ def register_handlers(
             return
         role_arg = role_arg.lower()
 
-        if role_arg not in ["user", "admin"]:
+        if role_arg not in _VALID_INVITE_ROLES:
             bot_helper.send_cmd_reply(message, "❌ 权限类型必须是 `user` 或 `admin`", parse_mode="Markdown")
             return
         new_code = onetime_code_manager.generate_code(role_arg, message.from_user.id, cfg.ONETIME_CODE_LENGTH)
-        bot_username = bot_helper.get_username()
+        bot_username, _ = _bot_identity_get()
         invite_link = f"https://t.me/{bot_username}?start={new_code}"
         invite_link_display = invite_link.replace("_", "\\_")
         role_display = "👤 普通用户" if role_arg == "user" else "👮 管理员"
@@ -511,22 +531,22 @@ def register_handlers(
         )
 
     @bot.message_handler(commands=['lc'])
-    @private_only
-    @require_super_admin
+    @guarded(private=True, role='super_admin')
     def cmd_lc(message):
         codes = onetime_code_manager.list_codes()
         if not codes:
             bot_helper.send_cmd_reply(message, "📋 当前没有未使用的一次性邀请码。")
             return
-        lines = ["📋 *未使用的一次性邀请码*\n"]
-        for info in codes:
-            role_emoji = "👮" if info["role"] == "admin" else "👤"
-            lines.append(f"{role_emoji} `{info['code']}` - {info['created_at']}")
-        bot_helper.send_cmd_reply(message, "\n".join(lines), parse_mode="Markdown")
+        body = [
+            f"{'👮' if info['role'] == 'admin' else '👤'} `{info['code']}` - "
+            f"{datetime.datetime.fromtimestamp(info['created_at']).strftime('%Y-%m-%d %H:%M:%S')}"
+            for info in codes
+        ]
+        msg = "📋 *未使用的一次性邀请码*\n\n" + "\n".join(body)
+        bot_helper.send_cmd_reply(message, msg, parse_mode="Markdown")
 
     @bot.message_handler(commands=['rmc'])
-    @private_only
-    @require_super_admin
+    @guarded(private=True, role='super_admin')
     def cmd_rmc(message):
         code_to_revoke = _get_cmd_arg(message, 1, "⚠️ 请指定要撤销的邀请码。用法: `/rmc 邀请码`")
         if not code_to_revoke:
@@ -537,28 +557,24 @@ def register_handlers(
             bot_helper.send_cmd_reply(message, f"❌ 邀请码 `{code_to_revoke}` 不存在或已被使用。", parse_mode="Markdown")
 
     @bot.message_handler(commands=['recent_users', 'logs'])
-    @private_only
-    @require_admin
+    @guarded(private=True, role='admin')
     def cmd_recent_users(message):
         logs = auth_manager.get_recent_logs(limit=10)
         log_text = "".join(logs)
         bot_helper.send_cmd_reply(message, f"📜 *最近白名单变动记录*:\n\n```\n{log_text}```", parse_mode="Markdown")
 
     @bot.message_handler(commands=['set_private', 'sp'])
-    @private_only
-    @require_whitelist
+    @guarded(private=True, role='whitelist')
     def cmd_set_private(message):
         _handle_set_prompt(message, "private", "/sp")
 
     @bot.message_handler(commands=['set_group', 'sg'])
-    @private_only
-    @require_whitelist
+    @guarded(private=True, role='whitelist')
     def cmd_set_group(message):
         _handle_set_prompt(message, "group", "/sg")
 
     @bot.message_handler(commands=['add_admin'])
-    @private_only
-    @require_super_admin
+    @guarded(private=True, role='super_admin')
     def cmd_add_admin(message):
         try:
             arg = _get_cmd_arg(
@@ -574,8 +590,7 @@ def register_handlers(
             bot_helper.send_cmd_reply(message, "❌ ID 必须是数字。")
 
     @bot.message_handler(commands=['add'])
-    @private_only
-    @require_admin
+    @guarded(private=True, role='admin')
     def cmd_add_user(message):
         target_id = None
         target_name = "ID用户"
@@ -585,19 +600,18 @@ def register_handlers(
             target_user_obj = message.reply_to_message.from_user
             target_name = auth_manager.get_display_name(target_user_obj)
         else:
-            args = message.text.split()
-            if len(args) >= 2 and args[1].isdigit():
+            args = _args(message)
+            try:
                 target_id = int(args[1])
-                target_name = str(target_id)
-            else:
+            except (IndexError, ValueError):
                 bot_helper.send_cmd_reply(message, "⚠️ 使用方法：\n1. 回复某人的消息发送 `/add`\n2. 发送 `/add` 用户ID\n例: `/add 12345678`", parse_mode="Markdown")
                 return
+            target_name = str(target_id)
         auth_manager.add_user(target_id, source="管理员添加", user_obj=target_user_obj)
         bot_helper.send_cmd_reply(message, f"✅ 已添加白名单: {target_name} (`{target_id}`)", parse_mode="Markdown")
 
     @bot.message_handler(commands=['del'])
-    @private_only
-    @require_admin
+    @guarded(private=True, role='admin')
     def cmd_del_user(message):
         user_id = message.from_user.id
         target_id = None
@@ -606,13 +620,13 @@ def register_handlers(
             target_id = message.reply_to_message.from_user.id
             target_name = auth_manager.get_display_name(message.reply_to_message.from_user)
         else:
-            args = message.text.split()
-            if len(args) >= 2 and args[1].isdigit():
+            args = _args(message)
+            try:
                 target_id = int(args[1])
-                target_name = str(target_id)
-            else:
+            except (IndexError, ValueError):
                 bot_helper.send_cmd_reply(message, "⚠️ 使用方法：\n1. 回复某人的消息发送 `/del`\n2. 发送 `/del` 用户ID\n例: `/del 12345678`", parse_mode="Markdown")
                 return
+            target_name = str(target_id)
         if auth_manager.get_role(target_id) == "admin" and not auth_manager.is_super_admin(user_id):
             bot_helper.send_cmd_reply(message, "⛔ 你没有权限删除其他管理员。")
             return
@@ -624,8 +638,7 @@ def register_handlers(
         bot_helper.send_cmd_reply(message, f"🗑️ 已移除权限: {target_name} (`{target_id}`)", parse_mode="Markdown")
 
     @bot.message_handler(commands=['temp'])
-    @private_only
-    @require_admin
+    @guarded(private=True, role='admin')
     def cmd_set_temp(message):
         try:
             arg = _get_cmd_arg(
@@ -645,8 +658,7 @@ def register_handlers(
             bot_helper.send_cmd_reply(message, "❌ 请输入有效的数字。")
 
     @bot.message_handler(commands=['list'])
-    @private_only
-    @require_admin
+    @guarded(private=True, role='admin')
     def cmd_list_users(message):
         admins_list, users_list = auth_manager.get_user_lists_formatted()
         pass
@@ -672,13 +684,13 @@ def register_handlers(
 
         if not auth_manager.can_use_chat(user_id, chat_type):
             return
-        if chat_type in ['group', 'supergroup']:
+        if chat_type in _GROUP_CHAT_TYPES:
             if not auth_manager.is_admin(user_id):
                 bot_helper.send_cmd_reply(message, "⛔ 只有管理员可以使用 /clear 指令。")
                 return
 
         with chat_locks.get_lock(chat_id):
-            context_manager.update_context(chat_id, [], force_save=True)
+            context_manager.update_context(chat_id, [], force_save=True, take_ownership=True)
             context_manager.set_cooldown(chat_id, 0)
 
         if chat_type == 'private':
@@ -687,7 +699,7 @@ def register_handlers(
         bot_helper.send_cmd_reply(message, "🧹 我们的回忆已清空，现在重新开始吧。")
 
     @bot.message_handler(commands=['version', 'ver', 'v'])
-    @private_only
+    @guarded(private=True)
     def show_version(message):
         bot_helper.send_cmd_reply(
             message,
@@ -699,8 +711,7 @@ def register_handlers(
         )
 
     @bot.message_handler(commands=['usage', 'quota', 'limit'])
-    @private_only
-    @require_whitelist
+    @guarded(private=True, role='whitelist')
     def cmd_check_usage(message):
         chat_type = _get_chat_type(message)
         user_id = message.from_user.id
@@ -715,53 +726,15 @@ def register_handlers(
                    f"📅 今日: `{stats['daily_used']}/{stats['daily_limit']}` (剩余 {daily_remaining} 次)")
         bot_helper.send_cmd_reply(message, msg, parse_mode="Markdown")
 
-    @bot.message_handler(func=lambda message: True)
-    def handle_message(message):
+    def _full_ingest(message, display_name, user_input):
         user_id = message.from_user.id
         chat_id = message.chat.id
         chat_id_str = str(chat_id)
-        user_input = (message.text or message.caption or "").strip()
         chat_type = message.chat.type
-        display_name = auth_manager.get_display_name(message.from_user)
-
-        if auth_manager.can_use_chat(user_id, chat_type):
-            auth_manager.update_user_info(user_id, display_name)
-
-        if not auth_manager.can_use_chat(user_id, chat_type):
-            if chat_type == 'private':
-                _reply_unauthorized(message, user_id)
-            return
-        if not user_input:
-            if chat_type == 'private':
-                bot_helper.safe_reply_to(message, "⚠️ 暂不支持该类型消息，请发送文字。")
-            return
-
-        should_reply = False
-        bot_username = bot_helper.get_username()
-
-        if chat_type == 'private':
-            should_reply = True
-        else:
-            if bot_username and f"@{bot_username}" in user_input:
-                should_reply = True
-                user_input = user_input.replace(f"@{bot_username}", "").strip()
-            elif message.reply_to_message and \
-                 message.reply_to_message.from_user and \
-                 message.reply_to_message.from_user.username == bot_username:
-                should_reply = True
-
-        if not should_reply:
-            return
-
-        allowed, error_msg = rate_limiter.check_and_record(user_id, chat_type)
-        if not allowed:
-            bot_helper.safe_reply_to(message, error_msg)
-            return
-
         chat_lock = chat_locks.get_lock(chat_id_str)
         msgs_to_summarize = None
 
-        user_msg_uuid = str(uuid.uuid4())
+        user_msg_uuid = uuid.uuid4().hex
         if chat_type != 'private':
             content_with_identity = f"[{display_name} (ID:{user_id})]: {user_input}"
             user_msg_obj = {"role": "user", "content": content_with_identity, "uuid": user_msg_uuid}
@@ -769,18 +742,21 @@ def register_handlers(
             user_msg_obj = {"role": "user", "content": user_input, "uuid": user_msg_uuid}
 
         with chat_lock:
-            context = context_manager.get_context(chat_id_str)
-            context.append(user_msg_obj)
+            context = context_manager.append_message(chat_id_str, user_msg_obj)
             task_msgs, forced_context = check_and_prepare_task(context_manager, cfg, chat_id_str, chat_type, context)
 
             if forced_context:
+                context_manager.update_context(chat_id_str, forced_context, force_save=True, take_ownership=True)
                 context = forced_context
-                context_manager.update_context(chat_id_str, context, force_save=True)
                 msgs_to_summarize = None
             else:
-                context_manager.update_context(chat_id_str, context)
                 msgs_to_summarize = task_msgs
 
+            # 不需要摘要时上下文已定，顺带取出回复用的消息，core_reply_cycle 不必再加锁读一次
+            api_context = None
+            if not msgs_to_summarize:
+                api_context = [{"role": m["role"], "content": m["content"]} for m in context]
+
         if chat_type == 'private':
             async_logger.log(user_id, display_name, "User", user_input)
 
@@ -796,4 +772,50 @@ def register_handlers(
                 with chat_lock:
                     context_manager.set_cooldown(chat_id_str, 5)
 
-        chat_queue_manager.enqueue(chat_id_str, core_reply_cycle, chat_id, user_id, message, user_msg_uuid)
+        core_reply_cycle(chat_id, user_id, message, user_msg_uuid, chat_lock=chat_lock, api_context=api_context)
+
+    @bot.message_handler(func=lambda message: True)
+    def handle_message(message):
+        user_id = message.from_user.id
+        chat_id = message.chat.id
+        chat_id_str = str(chat_id)
+        user_input = (message.text or message.caption or "").strip()
+        chat_type = message.chat.type
+        display_name = auth_manager.get_display_name(message.from_user)
+
+        if not auth_manager.can_use_chat(user_id, chat_type):
+            if chat_type == 'private':
+                _reply_unauthorized(message, user_id)
+            return
+        auth_manager.update_user_info(user_id, display_name)
+
+        if not user_input:
+            if chat_type == 'private':
+                bot_helper.safe_reply_to(message, "⚠️ 暂不支持该类型消息，请发送文字。")
+            return
+
+        should_reply = False
+
+        if chat_type == 'private':
+            should_reply = True
+        else:
+            bot_username, mention_tag = _bot_identity_get()
+            idx = user_input.find(mention_tag) if mention_tag else -1
+            if idx >= 0:
+                should_reply = True
+                user_input = (user_input[:idx] + user_input[idx + len(mention_tag):]).strip()
+            elif message.reply_to_message and \
+                 message.reply_to_message.from_user and \
+                 message.reply_to_message.from_user.username == bot_username:
+                should_reply = True
+
+        if not should_reply:
+            return
+
+        allowed, error_msg = rate_limiter.check_and_record(user_id, chat_type)
+        if not allowed:
+            bot_helper.safe_reply_to(message, error_msg)
+            return
+
+        # 入上下文、摘要检查与回复统一放到该会话的队列线程里执行，处理线程只做鉴权和限流
+        chat_queue_manager.enqueue(chat_id_str, _full_ingest, message, display_name, user_input)
@@ -3,9 +3,9 @@ import time
 import threading
 import datetime
 import signal
+import logging
 import sys
 import telebot
-from requests.exceptions import ConnectTimeout
 from config import Config
 from database import Database
 from utils import (
@@ -50,6 +50,12 @@ def _log_polling_error_brief(e, cooldown=60):
         _last_polling_err["ts"] = now
         print(f"[Warn] Telegram polling: {type(e).__name__}: {e}")
 
+class _PollingExceptionHandler(telebot.ExceptionHandler):
+    """轮询中的异常交给 _log_polling_error_brief 限频打印；返回 True 表示已处理，telebot 不再逐次重试都记日志"""
+    def handle(self, exception):
+        _log_polling_error_brief(exception)
+        return True
+
 _shutdown_event = threading.Event()
 _shutdown_executed = threading.Lock()
 _shutdown_done = False
@@ -59,20 +65,20 @@ chat_locks = ChatLockManager(_shutdown_event)
 context_manager = ContextCacheManager(db, _shutdown_event)
 onetime_code_manager = OnetimeCodeManager(db)
 
-bot = telebot.TeleBot(cfg.TG_BOT_TOKEN)
+bot = telebot.TeleBot(cfg.TG_BOT_TOKEN, exception_handler=_PollingExceptionHandler())
 bot_helper = BotHelper(bot, cfg)
 
 provider_manager = ProviderManager(cfg, db)
 
-auth_manager = AuthManager(db, _normalize_super_admin_ids(cfg.SUPER_ADMIN_ID))
+auth_manager = AuthManager(db, _normalize_super_admin_ids(cfg.SUPER_ADMIN_ID), _shutdown_event)
 auth_manager.sync_super_admins()
 
 settings_manager = SettingsManager(db)
 
-rate_limiter = RateLimiter(db, auth_manager, cfg)
+rate_limiter = RateLimiter(db, auth_manager, cfg, _shutdown_event)
 usage_manager = UsageManager(db, auth_manager, cfg)
 
-chat_queue_manager = ChatQueueManager(_shutdown_event, _log_exception)
+chat_queue_manager = ChatQueueManager(_shutdown_event, _log_exception, cfg.CHAT_WORKER_COUNT)
 
 # 注册 handlers
 register_handlers(
@@ -105,10 +111,14 @@ def _do_shutdown():
         _shutdown_done = True
     print("\n[System] 正在执行清理程序...")
     _shutdown_event.set()
+    chat_queue_manager.stop()
     print(" -> 正在保存所有对话上下文...")
     context_manager.flush_all()
     print(" -> 正在停止异步日志记录器...")
     async_logger.stop()
+    print(" -> 正在写入限流计数...")
+    rate_limiter.stop()
+    auth_manager.stop()
     print(" -> 正在关闭数据库连接...")
     db.close()
     print("[System] ✅ 所有资源已释放，程序已完全退出。")
@@ -127,20 +137,9 @@ def bot_polling_worker():
     except Exception as e:
         _log_polling_error_brief(e)
 
-    backoff = 1
-    while not _shutdown_event.is_set():
-        try:
-            bot.polling(non_stop=False, interval=1, timeout=20)
-            backoff = 1
-        except ConnectTimeout as e:
-            _log_polling_error_brief(e)
-            time.sleep(backoff)
-            backoff = min(backoff * 2, 30)
-        except Exception as e:
-            if _shutdown_event.is_set():
-                break
-            _log_polling_error_brief(e)
-            time.sleep(3)
+    # 长轮询：Telegram 有更新才返回；infinity_polling 自带异常重试，stop_polling() 后退出；
+    # 轮询异常由 _PollingExceptionHandler 限频打印，与原先手写循环的输出一致
+    bot.infinity_polling(timeout=20, long_polling_timeout=50, logger_level=logging.WARNING)
 
 def main():
     print(f"""
@@ -157,16 +156,14 @@ def main():
         polling_thread.start()
 
         print("[System] 🚀 服务已启动，正在监听消息...")
-        last_report_time = 0
         report_interval = 3600
-        while not _shutdown_event.is_set():
-            current_time = time.time()
-            if current_time - last_report_time > report_interval:
-                ts = datetime.datetime.now().strftime("%H:%M:%S")
-                active_threads = threading.active_count()
-                print(f"[Status {ts}] 🟢 运行中 | 活跃线程数: {active_threads}")
-                last_report_time = current_time
-            time.sleep(1)
+        # 直接在关闭事件上等待，到点打印一次状态，收到信号立即返回
+        while True:
+            ts = datetime.datetime.now().strftime("%H:%M:%S")
+            active_threads = threading.active_count()
+            print(f"[Status {ts}] 🟢 运行中 | 活跃线程数: {active_threads}")
+            if _shutdown_event.wait(timeout=report_interval):
+                break
     except KeyboardInterrupt:
         print("\n[System] 检测到键盘中断 (Ctrl+C)...")
         _shutdown_event.set()
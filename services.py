@@ -1,9 +1,16 @@
 # services.py
+import sys
 import time
 import threading
 import uuid
 import datetime
 import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 针对 Markdown V1/V2 的关键字符
+_MD_NAME_ESCAPE_TABLE = str.maketrans({c: f'\\{c}' for c in '_*[]`'})
+_ADMIN_ROLES = frozenset(("admin", "super_admin"))
 
 
 def _normalize_super_admin_ids(raw):
@@ -24,45 +31,69 @@ def _normalize_super_admin_ids(raw):
 
 
 class AuthManager:
-    def __init__(self, db, super_admin_ids):
+    NAME_FLUSH_INTERVAL = 0.5
+
+    def __init__(self, db, super_admin_ids, shutdown_event=None):
         self.db = db
         self._lock = threading.RLock()
-        self.super_admin_ids = set(super_admin_ids or [])
+        self.super_admin_ids = frozenset(super_admin_ids or ())
+        self.whitelist_ids = frozenset()
+        self.admin_ids = frozenset()
+        self._roles = {}
+        self._refresh_id_sets()
+        # 显示名更新先按用户合并，由常驻线程定时批量写库
+        self._pending_names = {}
+        self._names_lock = threading.Lock()
+        self._shutdown_event = shutdown_event or threading.Event()
+        self._name_writer = threading.Thread(target=self._name_writer_worker, daemon=True)
+        self._name_writer.start()
+
+    def _refresh_id_sets(self):
+        """按数据库重建角色表和白名单/管理员 ID 集合；仅在用户增删时调用，逐条消息的鉴权只查内存"""
+        whitelist, admins = set(self.super_admin_ids), set(self.super_admin_ids)
+        roles = {}
+        for uid, role in self.db.list_user_roles():
+            # 数据库每行返回新的 str 对象，驻留后所有条目共用同一个角色字符串，比较时先命中身份判断
+            role = roles[uid] = sys.intern(role) if role else role
+            if role in _ADMIN_ROLES:
+                admins.add(uid)
+                whitelist.add(uid)
+            elif role == "user":
+                whitelist.add(uid)
+        self.admin_ids = frozenset(admins)
+        self.whitelist_ids = frozenset(whitelist)
+        self._roles = roles
 
     def sync_super_admins(self):
         with self._lock:
-            desired = set(self.super_admin_ids)
+            desired = self.super_admin_ids
             existing = set(self.db.list_super_admin_ids())
 
-            for uid in existing - desired:
-                self.db.delete_user(uid)
-                self.db.add_system_log("移除超级管理员", uid, str(uid), "config-sync")
-
-            for uid in desired:
-                self.db.upsert_user(uid, "super_admin", "超级管理员")
-                self.db.add_system_log("添加超级管理员", uid, str(uid), "config-sync")
+            removed = sorted(existing - desired)
+            added = sorted(desired)
+            logs = [("移除超级管理员", uid, str(uid), "config-sync", None) for uid in removed]
+            logs += [("添加超级管理员", uid, str(uid), "config-sync", None) for uid in added]
+            # 整个同步放在一个事务里，启动时只提交一次
+            with self.db.transaction():
+                self.db.delete_users(removed)
+                self.db.upsert_users([(uid, "super_admin", "超级管理员") for uid in added])
+                self.db.add_system_logs_bulk(logs)
+            self._refresh_id_sets()
 
     def get_role(self, user_id):
         if user_id in self.super_admin_ids:
             return "super_admin"
-        row = self.db.get_user(user_id)
-        return row["role"] if row else None
+        return self._roles.get(user_id)
 
     def is_super_admin(self, user_id):
         return user_id in self.super_admin_ids
 
     def is_admin(self, user_id):
-        return self.get_role(user_id) in ("admin", "super_admin")
+        return user_id in self.admin_ids
 
-    def is_whitelisted(self, user_id):
-        return self.get_role(user_id) in ("user", "admin", "super_admin")
-        
     def can_use_chat(self, user_id, chat_type):
-        # 管理员永远允许
-        if self.is_admin(user_id):
-            return True
-        # 群聊和私聊都要求在白名单内
-        return self.is_whitelisted(user_id)
+        # 群聊和私聊都要求在白名单内；whitelist_ids 已包含全部管理员与超级管理员
+        return user_id in self.whitelist_ids
 
     def add_admin_by_invite(self, target_id, source="invite", user_obj=None):
         # 邀请码路径授权：admin 角色直接写入，不做“超级管理员”限制
@@ -72,13 +103,11 @@ class AuthManager:
             name = display_name if display_name else str(target_id)
             # 记录日志，方便追踪邀请码来源
             self.db.add_system_log("邀请码添加管理员", target_id, name, source)
+            self._refresh_id_sets()
 
     def should_rate_limit(self, user_id, chat_type):
-        if self.is_admin(user_id):
-            return False
-        if chat_type != "private" and self.get_role(user_id) == "user":
-            return True
-        return True
+        # 除管理员外，私聊和群聊一律限流
+        return user_id not in self.admin_ids
 
 
     def get_display_name(self, user_obj):
@@ -88,7 +117,30 @@ class AuthManager:
         return f"{first} {last} {username}".strip() or "Unknown"
 
     def update_user_info(self, user_id, display_name):
-        threading.Thread(target=self.db.update_display_name, args=(user_id, display_name), daemon=True).start()
+        user = self.db.get_user(user_id)
+        if user is None or user.display_name == display_name:
+            return
+        with self._names_lock:
+            self._pending_names[user_id] = display_name
+
+    def flush_display_names(self):
+        with self._names_lock:
+            if not self._pending_names:
+                return
+            pending, self._pending_names = self._pending_names, {}
+        try:
+            self.db.update_display_names(list(pending.items()))
+        except Exception as e:
+            print(f"[AuthManager] display name update failed: {e}")
+
+    def _name_writer_worker(self):
+        while not self._shutdown_event.wait(timeout=self.NAME_FLUSH_INTERVAL):
+            self.flush_display_names()
+
+    def stop(self):
+        self._shutdown_event.set()
+        self._name_writer.join(timeout=5)
+        self.flush_display_names()
 
     def add_admin(self, target_id, operator_id, source="admin", user_obj=None):
         with self._lock:
@@ -103,12 +155,14 @@ class AuthManager:
             self.db.upsert_user(target_id, "admin", self.get_display_name(user_obj) if user_obj else None)
             name = self.get_display_name(user_obj) if user_obj else str(target_id)
             self.db.add_system_log("添加管理员", target_id, name, source)
+            self._refresh_id_sets()
 
     def add_user(self, target_id, source="admin", user_obj=None):
         with self._lock:
             self.db.upsert_user(target_id, "user", self.get_display_name(user_obj) if user_obj else None)
             name = self.get_display_name(user_obj) if user_obj else str(target_id)
             self.db.add_system_log("添加白名单", target_id, name, source)
+            self._refresh_id_sets()
 
     def del_user(self, target_id, operator_id, source="admin"):
         """
@@ -142,34 +196,35 @@ class AuthManager:
             # 4. 执行删除
             self.db.delete_user(target_id)
             self.db.add_system_log("移除白名单", target_id, str(target_id), source)
+            self._refresh_id_sets()
 
     def get_user_lists_formatted(self):
         rows = self.db.list_users()
         admins_list, users_list = [], []
-        # 辅助内部函数用于转义，防止破坏 Markdown 结构
-        def escape_md_name(name):
-            chars = ['_', '*', '[', ']', '`'] # 针对 Markdown V1/V2 的关键字符
-            for c in chars:
-                name = name.replace(c, f'\\{c}')
-            return name
+        super_ids = self.super_admin_ids
         for r in rows:
-            name = escape_md_name(r["display_name"] or "未知")
-            # ID 也是数字，一般安全，但如果是 user_input 导致非数字 ID 则需注意
-            line = f"{name} (`{r['user_id']}`)" 
-            
-            if r["role"] in ("admin", "super_admin") and r["user_id"] not in self.super_admin_ids:
-                admins_list.append(line)
-            elif r["role"] == "user":
-                users_list.append(line)
+            role = r["role"]
+            # 先按角色分流，超级管理员和未知角色不必格式化
+            if role == "user":
+                target = users_list
+            elif role in _ADMIN_ROLES and r["user_id"] not in super_ids:
+                target = admins_list
+            else:
+                continue
+            # 转义名字，防止破坏 Markdown 结构；ID 是数字，一般安全
+            name = (r["display_name"] or "未知").translate(_MD_NAME_ESCAPE_TABLE)
+            target.append(f"{name} (`{r['user_id']}`)")
         return admins_list, users_list
     
     def get_recent_logs(self, limit=10):
-        rows = self.db.get_recent_logs(limit)
+        rows = self.db.get_recent_logs_with_names(limit)
         if not rows:
             return ["暂无日志记录"]
         lines = []
         for r in rows:
-            line = f"[{r['ts']}] {r['action']} - 用户: {r['user_name']} (ID:{r['target_id']}) - 来源: {r['source']}\n"
+            ts = datetime.datetime.fromtimestamp(r['ts']).strftime("%Y-%m-%d %H:%M:%S")
+            name = r['display_name'] or r['user_name']
+            line = f"[{ts}] {r['action']} - 用户: {name} (ID:{r['target_id']}) - 来源: {r['source']}\n"
             lines.append(line)
         return lines
 
@@ -184,79 +239,153 @@ class SettingsManager:
     def get_system_prompt(self, user_id, chat_type="private"):
         return self.db.get_prompt(user_id, chat_type)
 
+    def get_effective_prompt(self, cfg, user_id, prompt_type):
+        # 用户提示词由数据库层的 LRU 缓存，这里只做拼接
+        user_prompt = self.get_system_prompt(user_id, prompt_type)
+        base_prompt = user_prompt or cfg.DEFAULT_SYSTEM_PROMPT or ""
+        extra_prompt = cfg.EXTRA_SYSTEM_PROMPT or ""
+        return prompt_type, user_prompt, base_prompt, extra_prompt, base_prompt + extra_prompt
+
 
 class UsageManager:
     def __init__(self, db, auth_manager=None, cfg=None):
         self.db = db
         self.auth_manager = auth_manager
         self.cfg = cfg
-        self._lock = threading.RLock()
-
 
     def record_usage(self, user_id, model_name, msg_delta=1, token_delta=0, ts=None):
         if ts is None:
             ts = int(time.time())
-        with self._lock:
-            self.db.incr_usage(user_id, model_name, msg_delta, token_delta, ts)
+        # incr_usage 自带写缓冲锁，这里无需再加一层
+        self.db.incr_usage(user_id, model_name, msg_delta, token_delta, ts)
 
 
 class RateLimiter:
-    def __init__(self, db, auth_manager, cfg):
+    CLEANUP_INTERVAL = 7200
+
+    def __init__(self, db, auth_manager, cfg, shutdown_event=None):
         self.db = db
         self.auth_manager = auth_manager
         self.cfg = cfg
         self._lock = threading.RLock()
-        self._last_cleanup_timestamp = 0 
+        # (分钟桶, 小时键, 日键, 当前分钟数)；键只在跨小时/跨天时变化，同一分钟内直接复用
+        self._keys_cache = (None, None, None, 0)
+        # (小时键, 保留的小时键, 保留的日键)
+        self._retention_cache = (None, (), ())
+        # 当前小时/当天的计数放在内存里判定，落库交给后台线程；键变化时整表换新
+        self._hourly_key, self._hourly = None, {}
+        self._daily_key, self._daily = None, {}
+        self._shutdown_event = shutdown_event or threading.Event()
+        self._write_queue = queue.Queue()
+        self._writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self._writer_thread.start()
+        self._sweeper_thread = threading.Thread(target=self._sweeper, daemon=True)
+        self._sweeper_thread.start()
 
     def _get_current_keys(self):
-        now = datetime.datetime.now()
-        return now.strftime("%Y-%m-%d-%H"), now.strftime("%Y-%m-%d")
-
-    def _cleanup_old_records(self, user_id):
-        now = datetime.datetime.now()
-        hourly_keys = []
-        daily_keys = []
-        for i in range(24):
-            hourly_keys.append((now - datetime.timedelta(hours=i)).strftime("%Y-%m-%d-%H"))
-        for i in range(7):
-            daily_keys.append((now - datetime.timedelta(days=i)).strftime("%Y-%m-%d"))
-        self.db.cleanup_usage(user_id, "hourly", hourly_keys)
-        self.db.cleanup_usage(user_id, "daily", daily_keys)
+        minute = int(time.time()) // 60
+        cached = self._keys_cache
+        if cached[0] != minute:
+            now = datetime.datetime.now()
+            cached = (minute, now.strftime("%Y-%m-%d-%H"), now.strftime("%Y-%m-%d"), now.minute)
+            self._keys_cache = cached
+        return cached[1], cached[2]
+
+    def _cleanup_old_records(self):
+        hour_key, _ = self._get_current_keys()
+        cached = self._retention_cache
+        if cached[0] != hour_key:
+            now = datetime.datetime.now()
+            hourly_keys = tuple((now - datetime.timedelta(hours=i)).strftime("%Y-%m-%d-%H") for i in range(24))
+            daily_keys = tuple((now - datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7))
+            cached = (hour_key, hourly_keys, daily_keys)
+            self._retention_cache = cached
+        self.db.cleanup_usage_all("hourly", cached[1])
+        self.db.cleanup_usage_all("daily", cached[2])
+
+    def _sweeper(self):
+        # 启动时先清一次，之后每 CLEANUP_INTERVAL 秒统一清理全部用户的过期计数
+        while True:
+            try:
+                self._cleanup_old_records()
+            except Exception as e:
+                print(f"清理旧数据失败，但这不影响限流功能: {e}")
+            if self._shutdown_event.wait(timeout=self.CLEANUP_INTERVAL):
+                break
+
+    def _get_counts_unsafe(self, user_id, hour_key, day_key):
+        if hour_key != self._hourly_key:
+            self._hourly_key, self._hourly = hour_key, {}
+        if day_key != self._daily_key:
+            self._daily_key, self._daily = day_key, {}
+        hourly_count = self._hourly.get(user_id)
+        if hourly_count is None:
+            hourly_count = self._hourly[user_id] = self.db.get_usage(user_id, "hourly", hour_key)
+        daily_count = self._daily.get(user_id)
+        if daily_count is None:
+            daily_count = self._daily[user_id] = self.db.get_usage(user_id, "daily", day_key)
+        return hourly_count, daily_count
 
     def check_and_record(self, user_id, chat_type="private"):
         if not self.auth_manager.should_rate_limit(user_id, chat_type):
             return True, None
         hour_key, day_key = self._get_current_keys()
         with self._lock:
-            # 2. 修改：不要每次都清理，每隔 3600秒 (1小时) 清理一次
-            current_time = time.time()
-            if current_time - self._last_cleanup_timestamp > 7200:
-                # 这里为了不阻塞用户发消息，建议用线程去清理，或者就在这里清理也行（1小时卡顿一次没感觉）
-                try:
-                    self._cleanup_old_records(user_id)
-                    self._last_cleanup_timestamp = current_time
-                except Exception as e:
-                    print(f"清理旧数据失败，但这不影响限流功能: {e}")
-            hourly_count = self.db.get_usage(user_id, "hourly", hour_key)
-            daily_count = self.db.get_usage(user_id, "daily", day_key)
+            hourly_count, daily_count = self._get_counts_unsafe(user_id, hour_key, day_key)
 
             if hourly_count >= self.cfg.USER_RATE_LIMIT_HOURLY:
-                remaining_minutes = 60 - datetime.datetime.now().minute
+                remaining_minutes = 60 - self._keys_cache[3]
                 return False, f"⏰ 已达到每小时 {self.cfg.USER_RATE_LIMIT_HOURLY} 次限制。\n请等待约 {remaining_minutes} 分钟后再试。"
 
             if daily_count >= self.cfg.USER_RATE_LIMIT_DAILY:
                 return False, f"📅 已达到每天 {self.cfg.USER_RATE_LIMIT_DAILY} 次限制。\n请明天再来！"
 
-            self.db.set_usage(user_id, "hourly", hour_key, hourly_count + 1)
-            self.db.set_usage(user_id, "daily", day_key, daily_count + 1)
+            self._hourly[user_id] = hourly_count + 1
+            self._daily[user_id] = daily_count + 1
+            self._write_queue.put((user_id, hour_key, hourly_count + 1, day_key, daily_count + 1))
             return True, None
 
+    def _writer(self):
+        while not self._shutdown_event.is_set():
+            try:
+                first = self._write_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            self._flush_writes(first)
+
+    def _flush_writes(self, first=None):
+        # 同一用户同一时段只保留最后一次计数，合并后在一个事务里写入
+        latest = {}
+        record = first
+        while True:
+            if record is not None:
+                user_id, hour_key, hourly_count, day_key, daily_count = record
+                latest[(user_id, "hourly", hour_key)] = hourly_count
+                latest[(user_id, "daily", day_key)] = daily_count
+            try:
+                record = self._write_queue.get_nowait()
+            except queue.Empty:
+                break
+        if not latest:
+            return
+        try:
+            with self.db.transaction():
+                for (user_id, scope, key), count in latest.items():
+                    self.db.set_usage(user_id, scope, key, count)
+        except Exception as e:
+            print(f"[RateLimiter] usage write failed: {e}")
+
+    def stop(self):
+        self._shutdown_event.set()
+        self._writer_thread.join(timeout=5)
+        self._flush_writes()
+
     def get_user_stats(self, user_id):
         if self.auth_manager.is_admin(user_id):
             return {"hourly_used": 0, "hourly_limit": "∞", "daily_used": 0, "daily_limit": "∞", "is_admin": True}
         hour_key, day_key = self._get_current_keys()
-        hourly_count = self.db.get_usage(user_id, "hourly", hour_key)
-        daily_count = self.db.get_usage(user_id, "daily", day_key)
+        with self._lock:
+            hourly_count, daily_count = self._get_counts_unsafe(user_id, hour_key, day_key)
         return {
             "hourly_used": hourly_count,
             "hourly_limit": self.cfg.USER_RATE_LIMIT_HOURLY,
@@ -267,70 +396,74 @@ class RateLimiter:
 
 
 class ChatQueueManager:
-    def __init__(self, shutdown_event, log_exception):
+    """固定大小的线程池处理各会话任务；同一会话同时只有一个 _drain 在跑，保证回复按序"""
+    def __init__(self, shutdown_event, log_exception, max_workers=8):
         self._shutdown_event = shutdown_event
         self._log_exception = log_exception
-        self._queues = {}
-        self._last_active = {}
-        self._idle_timeout = 600  # 秒
-        self._lock = threading.RLock()
+        self._pending = {}
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ChatWorker")
 
     def enqueue(self, chat_id_str, func, *args):
         with self._lock:
-            q = self._queues.get(chat_id_str)
-            if not q:
-                q = queue.Queue()
-                self._queues[chat_id_str] = q
-                self._last_active[chat_id_str] = time.time()
-                worker = threading.Thread(target=self._worker, args=(chat_id_str, q), daemon=True)
-                worker.start()
-            else:
-                self._last_active[chat_id_str] = time.time()
-        q.put((func, args))
+            # 关闭后线程池已不接受任务，submit 会抛 RuntimeError，直接丢弃
+            if self._stopped:
+                print(f"[ChatQueue] 正在关闭，丢弃 chat_id={chat_id_str} 的新消息")
+                return
+            pending = self._pending.get(chat_id_str)
+            if pending is None:
+                pending = self._pending[chat_id_str] = deque()
+            pending.append((func, args))
+            if chat_id_str in self._running:
+                return
+            self._running.add(chat_id_str)
+            # 在锁内提交，保证不会与 stop() 交错
+            self._executor.submit(self._drain, chat_id_str)
 
-    def _worker(self, chat_id_str, q):
+    def _drain(self, chat_id_str):
         while not self._shutdown_event.is_set():
+            with self._lock:
+                pending = self._pending.get(chat_id_str)
+                if not pending:
+                    # 队列已空才释放运行标记，之后的 enqueue 会重新提交
+                    self._pending.pop(chat_id_str, None)
+                    self._running.discard(chat_id_str)
+                    return
+                func, args = pending.popleft()
             try:
-                func, args = q.get(timeout=0.5)
-            except queue.Empty:
-                with self._lock:
-                    last = self._last_active.get(chat_id_str, 0)
-                    if time.time() - last > self._idle_timeout:
-                        if self._queues.get(chat_id_str) is q:
-                            self._queues.pop(chat_id_str, None)
-                            self._last_active.pop(chat_id_str, None)
-                        return
-                continue
-            try:
-                with self._lock:
-                    self._last_active[chat_id_str] = time.time()
                 func(*args)
             except Exception as e:
                 self._log_exception(f"ChatQueueWorker chat_id={chat_id_str}", e)
-            finally:
-                q.task_done()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
 
 
 def check_and_prepare_task(context_manager, cfg, chat_id_str, chat_type, context):
+    n = len(context)
     cooldown = context_manager.get_cooldown(chat_id_str)
     if cooldown > 0:
         context_manager.set_cooldown(chat_id_str, cooldown - 1)
-        if len(context) > cfg.MAX_SAFETY_LIMIT:
-            return None, context[-cfg.SUMMARY_TRIGGER_PRIVATE:]
-        return None, None
 
-    if len(context) > cfg.MAX_SAFETY_LIMIT:
+    # 超过安全上限时无论是否在冷却期都直接截断
+    if n > cfg.MAX_SAFETY_LIMIT:
         return None, context[-cfg.SUMMARY_TRIGGER_PRIVATE:]
+    if cooldown > 0:
+        return None, None
 
     if chat_type != 'private':
-        if len(context) > cfg.LIMIT_HISTORY_GROUP:
+        if n > cfg.LIMIT_HISTORY_GROUP:
             return None, context[-cfg.LIMIT_HISTORY_GROUP:]
         return None, None
 
-    if len(context) <= cfg.SUMMARY_TRIGGER_PRIVATE:
+    if n <= cfg.SUMMARY_TRIGGER_PRIVATE:
         return None, None
 
-    split_index = len(context) - cfg.SUMMARY_RETAIN_PRIVATE
+    split_index = n - cfg.SUMMARY_RETAIN_PRIVATE
     if split_index <= 0:
         return None, None
 
@@ -356,46 +489,23 @@ def apply_summary_success(context_manager, chat_id_str, msgs_to_summarize, summa
         summary_node = {
             "role": "system",
             "content": f"【长期记忆/前情提要】：{summary_text}",
-            "uuid": str(uuid.uuid4()),
-            "ts": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "uuid": uuid.uuid4().hex,
+            "ts": int(time.time())
         }
         remaining_context = current_context[msg_count:]
         new_context = [summary_node] + remaining_context
-        context_manager.update_context(chat_id_str, new_context, force_save=True)
+        context_manager.update_context(chat_id_str, new_context, force_save=True, take_ownership=True)
 
 
 def _get_context_slice_for_reply(context_manager, chat_id_str, target_uuid):
-    context = context_manager.get_context(chat_id_str)
-    if not target_uuid:
-        return context
-    for i, msg in enumerate(context):
-        if msg.get("uuid") == target_uuid:
-            return context[:i + 1]
-    return context
+    """返回截至 target_uuid（含）的上下文，消息只保留 role/content，可直接拼入 API 请求"""
+    return context_manager.get_reply_context(chat_id_str, target_uuid)
 
 
 def _insert_ai_reply(context_manager, chat_id_str, user_msg_uuid, ai_msg_obj):
-    context = context_manager.get_context(chat_id_str)
-    if user_msg_uuid:
-        for existing in context:
-            if existing.get("reply_to") == user_msg_uuid:
-                return
-    insert_index = None
-    if user_msg_uuid:
-        for i, msg in enumerate(context):
-            if msg.get("uuid") == user_msg_uuid:
-                insert_index = i + 1
-                break
-    if insert_index is None or insert_index > len(context):
-        context.append(ai_msg_obj)
-    else:
-        context.insert(insert_index, ai_msg_obj)
-    context_manager.update_context(chat_id_str, context)
+    context_manager.insert_reply(chat_id_str, user_msg_uuid, ai_msg_obj)
 
 
 def _build_effective_system_prompt(settings_manager, cfg, user_id, chat_type):
     prompt_type = "private" if chat_type == "private" else "group"
-    user_prompt = settings_manager.get_system_prompt(user_id, prompt_type)
-    base_prompt = user_prompt or cfg.DEFAULT_SYSTEM_PROMPT or ""
-    extra_prompt = cfg.EXTRA_SYSTEM_PROMPT or ""
-    return prompt_type, user_prompt, base_prompt, extra_prompt, base_prompt + extra_prompt
+    return settings_manager.get_effective_prompt(cfg, user_id, prompt_type)
@@ -2,20 +2,33 @@
 import time
 import threading
 import uuid
-import copy
+import itertools
 import queue
 import secrets
 import string
 import telebot
 import sys
 import re
-from openai import OpenAI
+import heapq
+import sqlite3
+from collections import OrderedDict
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+
+# DOTALL 确保 . 能匹配换行符，把 <think> 到 </think> 中间所有东西删掉
+_COT_RE = re.compile(r'<think>.*?</think>', re.DOTALL)
+# 被回复的消息已不存在，如 "message to be replied not found"；两个关键词不要求先后顺序
+_REPLY_MISSING_RE = re.compile(r'(?=.*repl(?:y|ied))(?=.*not found)', re.IGNORECASE | re.DOTALL)
 
 class AsyncLogger:
+    BATCH_SIZE = 256
+
     def __init__(self, db, shutdown_event):
         self.db = db
         self._shutdown_event = shutdown_event
-        self._queue = queue.Queue()
+        self._queue = queue.SimpleQueue()
         self._running = True
         self._worker_thread = threading.Thread(target=self._worker, daemon=True)
         self._worker_thread.start()
@@ -30,27 +43,46 @@ class AsyncLogger:
             if self._shutdown_event.is_set() and self._queue.empty():
                 break
             try:
-                record = self._queue.get(timeout=1)
+                records = [self._queue.get(timeout=1)]
             except queue.Empty:
                 continue
+            # 拿到第一条后把队列里已积压的一并取出（有上限），一个事务写入
+            self._write_batch(self._drain_into(records))
+
+    def _drain_into(self, records):
+        while len(records) < self.BATCH_SIZE:
             try:
-                user_id, user_name, role, content, is_system = record
-                action = "chat_log_system" if is_system else "chat_log"
-                detail = f"{role}: {content}"
-                self.db.add_system_log(action, target_id=user_id, user_name=user_name, detail=detail)
-            except Exception as e:
-                print(f"[AsyncLogger] log failed: {e}", file=sys.stderr)
-            finally:
-                self._queue.task_done()
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+    def _write_batch(self, records):
+        rows = []
+        for user_id, user_name, role, content, is_system in records:
+            action = "chat_log_system" if is_system else "chat_log"
+            rows.append((action, user_id, user_name, None, f"{role}: {content}"))
+        try:
+            self.db.add_system_logs_bulk(rows)
+        except Exception as e:
+            print(f"[AsyncLogger] log failed: {e}", file=sys.stderr)
 
     def stop(self):
         self._running = False
         self._worker_thread.join(timeout=5)
+        # 线程退出后队列里若还有残留（如 stop 前一刻刚入队），在这里补写；
+        # join 超时说明 worker 仍在写，队列留给它，避免两边并发取出打乱顺序
+        if self._worker_thread.is_alive():
+            return
+        while records := self._drain_into([]):
+            self._write_batch(records)
 
 class ChatLockManager:
+    SHARD_COUNT = 32  # 必须是 2 的幂
+
     def __init__(self, shutdown_event, ttl_seconds=600):
-        self._locks = {}
-        self._global_lock = threading.Lock()
+        # 按 chat_id 哈希分桶，每桶一把锁，不同会话取锁互不阻塞
+        self._shards = [(threading.Lock(), {}) for _ in range(self.SHARD_COUNT)]
         self._ttl = ttl_seconds
         self._shutdown_event = shutdown_event
         self._cleaner = threading.Thread(target=self._auto_cleanup, daemon=True)
@@ -58,12 +90,17 @@ class ChatLockManager:
 
     def get_lock(self, chat_id):
         chat_id_str = str(chat_id)
-        with self._global_lock:
-            if chat_id_str not in self._locks:
-                self._locks[chat_id_str] = [threading.RLock(), time.time()]
-            else:
-                self._locks[chat_id_str][1] = time.time()
-            return self._locks[chat_id_str][0]
+        shard_lock, locks = self._shards[hash(chat_id_str) & (self.SHARD_COUNT - 1)]
+        now = time.time()
+        with shard_lock:
+            entry = locks.get(chat_id_str)
+            if entry is None:
+                # 调用方从不在持锁时重入同一会话锁，普通 Lock 足够
+                entry = locks[chat_id_str] = [threading.Lock(), now]
+            elif now - entry[1] >= 1:
+                # TTL 以 10 分钟计，1 秒内的重复访问不必刷新时间戳
+                entry[1] = now
+            return entry[0]
 
     def _auto_cleanup(self):
         while not self._shutdown_event.is_set():
@@ -71,22 +108,25 @@ class ChatLockManager:
             if self._shutdown_event.is_set():
                 break
             current_time = time.time()
-            with self._global_lock:
-                keys_to_remove = []
-                for cid, (lock_obj, last_time) in self._locks.items():
-                    if current_time - last_time > self._ttl:
-                        acquired = lock_obj.acquire(blocking=False)
-                        if acquired:
-                            lock_obj.release()
-                            keys_to_remove.append(cid)
-                for k in keys_to_remove:
-                    del self._locks[k]
+            for shard_lock, locks in self._shards:
+                with shard_lock:
+                    keys_to_remove = []
+                    for cid, (lock_obj, last_time) in locks.items():
+                        if current_time - last_time > self._ttl:
+                            acquired = lock_obj.acquire(blocking=False)
+                            if acquired:
+                                lock_obj.release()
+                                keys_to_remove.append(cid)
+                    for k in keys_to_remove:
+                        del locks[k]
 
 class ContextCacheManager:
+    # 消息 dict 写入缓存后不再原地修改（只整条替换/增删），因此读写快照都只做浅拷贝
     def __init__(self, db, shutdown_event):
         self.db = db
         self._shutdown_event = shutdown_event
-        self._cache = {}
+        # 按最近访问排序：队首最久未用，命中时 move_to_end
+        self._cache = OrderedDict()
         self._cache_lock = threading.Lock()
 
         self.SAVE_THRESHOLD = 3
@@ -94,33 +134,146 @@ class ContextCacheManager:
         self.AUTO_SAVE_INTERVAL = 10800
 
         self.MAX_CACHE_ENTRIES = 1000
+        self.FLUSH_DEBOUNCE = 0.25
+        # 达到阈值的会话先记入 _dirty_set，由后台线程稍等片刻合并后再落库
+        self._dirty_set = set()
+        self._flush_wake = threading.Event()
         self._maintenance_thread = threading.Thread(target=self._maintenance_worker, daemon=True)
         self._maintenance_thread.start()
+        self._flush_thread = threading.Thread(target=self._flush_worker, daemon=True)
+        self._flush_thread.start()
 
     def _ensure_uuid(self, context_data):
         for msg in context_data:
             if "uuid" not in msg:
-                msg["uuid"] = str(uuid.uuid4())
+                msg["uuid"] = uuid.uuid4().hex
         return context_data
 
+    def _preload(self, cid):
+        """锁外预读：缓存未命中时先在锁外读库，冷加载不再阻塞其它会话；命中返回 None"""
+        # 这里的成员判断不加锁，只是提示，持锁后 _load_entry_unsafe 会再确认一次
+        if cid in self._cache:
+            return None
+        return self._ensure_uuid(self.db.load_chat_history(cid))
+
+    def _load_entry_unsafe(self, cid, current_time, preloaded=None):
+        """取出缓存条目，未命中时优先用 preloaded，否则从数据库加载；返回 (entry, pending_evictions)"""
+        entry = self._cache.get(cid)
+        if entry is not None:
+            # 预读期间已被其它线程放进缓存，以缓存里的为准
+            entry["last_access"] = current_time
+            self._cache.move_to_end(cid)
+            return entry, []
+        if preloaded is not None:
+            data = preloaded
+        else:
+            data = self._ensure_uuid(self.db.load_chat_history(cid))
+        entry = {
+            "data": data,
+            "dirty_count": 0,
+            "summary_cooldown": 0,
+            "last_access": current_time
+        }
+        self._cache[cid] = entry
+        return entry, self._check_cache_limit_unsafe()
+
     def get_context(self, chat_id):
         cid = str(chat_id)
-        pending_evictions = []
+        preloaded = self._preload(cid)
         with self._cache_lock:
-            current_time = time.time()
-            if cid not in self._cache:
-                data = self.db.load_chat_history(cid)
-                data = self._ensure_uuid(data)
-                self._cache[cid] = {
-                    "data": data,
-                    "dirty_count": 0,
-                    "summary_cooldown": 0,
-                    "last_access": current_time
-                }
-                pending_evictions = self._check_cache_limit_unsafe()
-            else:
-                self._cache[cid]["last_access"] = current_time
-            result = copy.deepcopy(self._cache[cid]["data"])
+            entry, pending_evictions = self._load_entry_unsafe(cid, time.time(), preloaded)
+            result = list(entry["data"])
+        if pending_evictions:
+            self._flush_evictions(pending_evictions)
+        return result
+
+    def append_message(self, chat_id, msg):
+        """只把一条消息追加进缓存，不整表拷贝回写；返回的列表仅供只读（如摘要判断）"""
+        cid = str(chat_id)
+        preloaded = self._preload(cid)
+        with self._cache_lock:
+            entry, pending_evictions = self._load_entry_unsafe(cid, time.time(), preloaded)
+            entry["data"].append(dict(msg))
+            self._index_appended_unsafe(entry)
+            entry["dirty_count"] += 1
+            should_save = entry["dirty_count"] >= self.SAVE_THRESHOLD
+            result = list(entry["data"])
+        if pending_evictions:
+            self._flush_evictions(pending_evictions)
+        if should_save:
+            self._schedule_flush(cid)
+        return result
+
+    def _uuid_pos_unsafe(self, entry):
+        """uuid -> 下标索引，首次用到时建立；整体替换上下文后作废重建"""
+        uuid_pos = entry.get("uuid_pos")
+        if uuid_pos is None:
+            uuid_pos = {msg.get("uuid"): i for i, msg in enumerate(entry["data"])}
+            entry["uuid_pos"] = uuid_pos
+        return uuid_pos
+
+    def _replied_unsafe(self, entry):
+        """已有回复的用户消息 uuid 集合，与 uuid_pos 一样惰性建立"""
+        replied = entry.get("replied")
+        if replied is None:
+            replied = {msg["reply_to"] for msg in entry["data"] if msg.get("reply_to")}
+            entry["replied"] = replied
+        return replied
+
+    def _index_appended_unsafe(self, entry):
+        data = entry["data"]
+        msg = data[-1]
+        uuid_pos = entry.get("uuid_pos")
+        if uuid_pos is not None:
+            uuid_pos[msg.get("uuid")] = len(data) - 1
+        replied = entry.get("replied")
+        if replied is not None and msg.get("reply_to"):
+            replied.add(msg["reply_to"])
+
+    def insert_reply(self, chat_id, user_msg_uuid, ai_msg):
+        """把 AI 回复插到对应用户消息之后；该消息已有回复时忽略"""
+        cid = str(chat_id)
+        should_save = False
+        preloaded = self._preload(cid)
+        with self._cache_lock:
+            entry, pending_evictions = self._load_entry_unsafe(cid, time.time(), preloaded)
+            data = entry["data"]
+            pos = None
+            inserted = True
+            if user_msg_uuid:
+                if user_msg_uuid in self._replied_unsafe(entry):
+                    inserted = False
+                else:
+                    pos = self._uuid_pos_unsafe(entry).get(user_msg_uuid)
+            if inserted:
+                if pos is None or pos + 1 >= len(data):
+                    data.append(dict(ai_msg))
+                    self._index_appended_unsafe(entry)
+                else:
+                    # 中间插入会让后续下标整体后移，索引作废，下次用到时重建
+                    data.insert(pos + 1, dict(ai_msg))
+                    entry.pop("uuid_pos", None)
+                    entry.pop("replied", None)
+                entry["dirty_count"] += 1
+                should_save = entry["dirty_count"] >= self.SAVE_THRESHOLD
+        if pending_evictions:
+            self._flush_evictions(pending_evictions)
+        if should_save:
+            self._schedule_flush(cid)
+
+    def get_reply_context(self, chat_id, target_uuid):
+        """返回截至 target_uuid（含）的 role/content 列表，找不到时返回全部"""
+        cid = str(chat_id)
+        preloaded = self._preload(cid)
+        with self._cache_lock:
+            entry, pending_evictions = self._load_entry_unsafe(cid, time.time(), preloaded)
+            data = entry["data"]
+            end = len(data)
+            if target_uuid:
+                pos = self._uuid_pos_unsafe(entry).get(target_uuid)
+                if pos is not None:
+                    end = pos + 1
+            result = [{"role": m["role"], "content": m["content"]} for m in itertools.islice(data, end)]
         if pending_evictions:
             self._flush_evictions(pending_evictions)
         return result
@@ -129,18 +282,14 @@ class ContextCacheManager:
         pending_evictions = []
         if len(self._cache) <= self.MAX_CACHE_ENTRIES:
             return pending_evictions
-        entries_to_remove = len(self._cache) - int(self.MAX_CACHE_ENTRIES * 0.8)
-        if entries_to_remove <= 0:
-            return pending_evictions
-        sorted_entries = sorted(self._cache.items(), key=lambda x: x[1]["last_access"])
-        for i in range(min(entries_to_remove, len(sorted_entries))):
-            cid = sorted_entries[i][0]
-            entry_snapshot = copy.deepcopy(self._cache[cid])
-            pending_evictions.append((cid, entry_snapshot))
-            del self._cache[cid]
+        target = int(self.MAX_CACHE_ENTRIES * 0.8)
+        while len(self._cache) > target:
+            # 条目随即移出缓存，直接转交引用即可
+            pending_evictions.append(self._cache.popitem(last=False))
         return pending_evictions
 
-    def update_context(self, chat_id, new_context, force_save=False):
+    def update_context(self, chat_id, new_context, force_save=False, take_ownership=False):
+        """take_ownership=True 时直接接管 new_context，调用方之后不得再修改该列表"""
         cid = str(chat_id)
         should_save = False
         pending_evictions = []
@@ -150,14 +299,35 @@ class ContextCacheManager:
                     "data": [], "dirty_count": 0, "summary_cooldown": 0, "last_access": time.time()
                 }
                 pending_evictions = self._check_cache_limit_unsafe()
-            self._cache[cid]["data"] = copy.deepcopy(new_context)
+            self._cache[cid]["data"] = new_context if take_ownership else list(new_context)
+            self._cache[cid].pop("uuid_pos", None)
+            self._cache[cid].pop("replied", None)
             self._cache[cid]["dirty_count"] += 1
             self._cache[cid]["last_access"] = time.time()
-            should_save = force_save or self._cache[cid]["dirty_count"] >= self.SAVE_THRESHOLD
+            self._cache.move_to_end(cid)
+            should_save = self._cache[cid]["dirty_count"] >= self.SAVE_THRESHOLD
         if pending_evictions:
             self._flush_evictions(pending_evictions)
-        if should_save:
+        if force_save:
             self._flush_to_db(cid)
+        elif should_save:
+            self._schedule_flush(cid)
+
+    def _schedule_flush(self, cid):
+        with self._cache_lock:
+            self._dirty_set.add(cid)
+        self._flush_wake.set()
+
+    def _flush_worker(self):
+        while not self._shutdown_event.is_set():
+            self._flush_wake.wait(timeout=60)
+            if self._shutdown_event.wait(timeout=self.FLUSH_DEBOUNCE):
+                break
+            self._flush_wake.clear()
+            with self._cache_lock:
+                dirty, self._dirty_set = self._dirty_set, set()
+            for cid in dirty:
+                self._flush_to_db(cid)
 
     def _flush_evictions(self, pending_evictions):
         for cid, entry in pending_evictions:
@@ -172,25 +342,13 @@ class ContextCacheManager:
                         entry["last_access"] = time.time()
                         self._cache[cid] = entry
 
-    def _flush_to_db_unsafe(self, chat_id):
-        cid = str(chat_id)
-        if cid not in self._cache:
-            return
-        data_to_save = copy.deepcopy(self._cache[cid]["data"])
-        try:
-            self.db.save_chat_history(cid, data_to_save)
-        except Exception as e:
-            print(f"[ContextCache] save failed for {cid}: {e}", file=sys.stderr)
-            return
-        self._cache[cid]["dirty_count"] = 0
-
     def _flush_to_db(self, chat_id):
         cid = str(chat_id)
         data_to_save = None
         dirty_snapshot = 0
         with self._cache_lock:
             if cid in self._cache:
-                data_to_save = copy.deepcopy(self._cache[cid]["data"])
+                data_to_save = list(self._cache[cid]["data"])
                 dirty_snapshot = self._cache[cid]["dirty_count"]
         if data_to_save is not None:
             try:
@@ -238,39 +396,60 @@ class ContextCacheManager:
     def _evict_inactive_entries(self, current_time):
         pending_evictions = []
         with self._cache_lock:
-            keys_to_evict = []
-            for cid, entry in self._cache.items():
-                if current_time - entry["last_access"] > self.CACHE_TTL:
-                    keys_to_evict.append(cid)
-            for cid in keys_to_evict:
-                entry_snapshot = copy.deepcopy(self._cache[cid])
-                pending_evictions.append((cid, entry_snapshot))
-                del self._cache[cid]
+            # 队首最旧，遇到第一个未过期的即可停止
+            while self._cache:
+                cid, entry = next(iter(self._cache.items()))
+                if current_time - entry["last_access"] <= self.CACHE_TTL:
+                    break
+                pending_evictions.append(self._cache.popitem(last=False))
         return pending_evictions
 
     def remove_last_message(self, chat_id):
         cid = str(chat_id)
         with self._cache_lock:
             if cid in self._cache and self._cache[cid]["data"]:
-                self._cache[cid]["data"].pop()
+                msg = self._cache[cid]["data"].pop()
+                uuid_pos = self._cache[cid].get("uuid_pos")
+                if uuid_pos is not None:
+                    uuid_pos.pop(msg.get("uuid"), None)
+                replied = self._cache[cid].get("replied")
+                if replied is not None and msg.get("reply_to"):
+                    replied.discard(msg["reply_to"])
                 self._cache[cid]["dirty_count"] += 1
 
+_CODE_ALPHABET = (string.ascii_uppercase + string.digits).encode()
+# 252 = 36 * 7，丢弃 >= 252 的字节做拒绝采样，取模后各字符等概率
+_CODE_BYTE_LIMIT = 256 - 256 % len(_CODE_ALPHABET)
+
+def _random_code(length):
+    out = bytearray()
+    while len(out) < length:
+        # 一次取够一批随机字节，替代逐字符调用 secrets.choice
+        out += bytes(_CODE_ALPHABET[b % len(_CODE_ALPHABET)]
+                     for b in secrets.token_bytes(length * 2) if b < _CODE_BYTE_LIMIT)
+    return out[:length].decode()
+
 class OnetimeCodeManager:
     def __init__(self, db):
         self.db = db
         self._lock = threading.RLock()
+        # 已用过/作废的码仍留在表里且 code 唯一，所以查重集合只增不减
+        self._known = set(db.list_invitation_code_values())
 
     def generate_code(self, role, created_by, code_length=8):
-        alphabet = string.ascii_uppercase + string.digits
-        new_code = ''.join(secrets.choice(alphabet) for _ in range(code_length))
         with self._lock:
             while True:
-                row = self.db.query_one("SELECT code FROM invitation_codes WHERE code=?", (new_code,))
-                if not row:
-                    break
-                new_code = ''.join(secrets.choice(alphabet) for _ in range(code_length))
-            self.db.create_invitation_code(new_code, role, created_by)
-        return new_code
+                new_code = _random_code(code_length)
+                if new_code in self._known:
+                    continue
+                try:
+                    self.db.create_invitation_code(new_code, role, created_by)
+                except sqlite3.IntegrityError:
+                    # 其他进程写入了同一个码，记下后重试
+                    self._known.add(new_code)
+                    continue
+                self._known.add(new_code)
+                return new_code
 
     def validate_and_consume(self, code, used_by):
         with self._lock:
@@ -288,17 +467,21 @@ class AIService:
         self.client = client
         self.config = config  # ✅ 修复点：保存 config 到实例变量
         self.model = config.AI_MODEL_CHAT
+        # 每次请求都要用到的配置项直接挂在实例上
+        self.summary_model = config.AI_MODEL_SUMMARY
+        self.api_timeout = config.API_TIMEOUT
+        self.default_temp = config.DEFAULT_TEMP
 
     def get_chat_response(self, messages, temperature=None):
         if temperature is None:
-            temperature = self.config.DEFAULT_TEMP
+            temperature = self.default_temp
 
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 temperature=temperature,
-                timeout=self.config.API_TIMEOUT
+                timeout=self.api_timeout
             )
             return response.choices[0].message.content.strip()
         except Exception:
@@ -312,11 +495,13 @@ class AIService:
         # === 【新增】清洗思维链的内部函数 ===
         def clean_cot(content):
             if not content: return ""
-            # flags=re.DOTALL 确保 . 能匹配换行符，把 <think> 到 </think> 中间所有东西删掉
-            return re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL).strip()
+            # 绝大多数消息不含 <think>，先做子串判断再走正则
+            if "<think>" not in content:
+                return content.strip()
+            return _COT_RE.sub('', content).strip()
 
         # === 【修改】在拼接前先清洗内容 ===
-        text_block = "\n".join([f"{m['role']}: {clean_cot(m['content'])}" for m in messages])
+        text_block = "\n".join(f"{m['role']}: {clean_cot(m['content'])}" for m in messages)
         
         system_content = (
             "你是一个资深的对话记忆专家。请总结对话的**核心语境**和**互动关系**。"
@@ -334,10 +519,10 @@ class AIService:
         
         try:
             response = self.client.chat.completions.create(
-                model=self.config.AI_MODEL_SUMMARY,
+                model=self.summary_model,
                 messages=prompt,
                 temperature=0.3,
-                timeout=self.config.API_TIMEOUT
+                timeout=self.api_timeout
             )
             
             # 1. 先拿到结果
@@ -368,21 +553,30 @@ class ProviderManager:
 
     def _init_providers(self):
         print("[System] 正在初始化 AI 模型服务...")
+        # 所有服务商共用一个连接池，同一 host 的 keep-alive/TLS 连接可以复用；
+        # 用 SDK 的默认客户端，只改连接池上限，其余传输设置保持 SDK 默认
+        self.http_client = DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
         for p_conf in self.main_config.AI_PROVIDERS:
             name = p_conf['name']
 
-            # 深拷贝配置
-            sub_cfg = copy.deepcopy(self.main_config)
-            sub_cfg.AI_API_KEY = p_conf['api_key']
-            sub_cfg.AI_BASE_URL = p_conf['base_url']
-            sub_cfg.AI_MODEL_CHAT = p_conf['model']
-            sub_cfg.AI_MODEL_SUMMARY = p_conf['model']
+            # 只带 AIService 用得到的字段，不再深拷贝整个主配置
+            sub_cfg = SimpleNamespace(
+                AI_API_KEY=p_conf['api_key'],
+                AI_BASE_URL=p_conf['base_url'],
+                AI_MODEL_CHAT=p_conf['model'],
+                AI_MODEL_SUMMARY=p_conf['model'],
+                API_TIMEOUT=self.main_config.API_TIMEOUT,
+                DEFAULT_TEMP=self.main_config.DEFAULT_TEMP,
+            )
 
             try:
                 sub_client = OpenAI(
                     api_key=sub_cfg.AI_API_KEY,
                     base_url=sub_cfg.AI_BASE_URL,
-                    timeout=sub_cfg.API_TIMEOUT
+                    timeout=sub_cfg.API_TIMEOUT,
+                    http_client=self.http_client
                 )
                 # AIService 初始化
                 service = AIService(sub_client, sub_cfg)
@@ -396,23 +590,27 @@ class ProviderManager:
             print("❌ 严重错误: 没有可用的 AI 模型服务！")
             sys.exit(1)
 
-    def set_user_provider(self, user_id, provider_name):
+    def resolve_name(self, provider_name):
+        """把用户输入的模型名（忽略大小写与首尾空白）映射为已加载的规范名，找不到返回 None"""
         if not provider_name:
+            return None
+        if provider_name in self.services:
+            return provider_name
+        return self._name_map.get(provider_name.strip().lower())
+
+    def set_user_provider(self, user_id, provider_name):
+        canonical = self.resolve_name(provider_name)
+        if canonical is None:
             return False
-        key = provider_name.strip().lower()
-        canonical = self._name_map.get(key)
-        if canonical in self.provider_list:
-            return self.db.set_user_model(user_id, canonical)
-        return False
+        return self.db.set_user_model(user_id, canonical)
 
     def get_user_provider_name(self, user_id):
         pref = self.db.get_user_model(user_id)
         if pref:
             if pref in self.services:
                 return pref
-            key = pref.strip().lower()
-            mapped = self._name_map.get(key)
-            if mapped in self.services:
+            mapped = self._name_map.get(pref.strip().lower())
+            if mapped is not None:
                 # 修复历史大小写不一致的记录
                 self.db.set_user_model(user_id, mapped)
                 return mapped
@@ -440,12 +638,20 @@ class ProviderManager:
     def update_default_temp(self, new_temp):
         for service in self.services.values():
             service.config.DEFAULT_TEMP = new_temp
+            service.default_temp = new_temp
 
 class BotHelper:
     def __init__(self, bot_instance, cfg):
         self.bot = bot_instance
         self.cfg = cfg
         self._bot_info_cache = None
+        # 延迟删除：(到期时间, chat_id, message_id) 小顶堆，由一个调度线程按到期时间处理
+        self._del_heap = []
+        self._del_lock = threading.Lock()
+        self._del_wake = threading.Event()
+        self._del_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="MsgDelete")
+        self._del_thread = threading.Thread(target=self._delete_scheduler, daemon=True)
+        self._del_thread.start()
 
     def get_username(self):
         if self._bot_info_cache is None:
@@ -456,10 +662,8 @@ class BotHelper:
         try:
             return self.bot.reply_to(message, text, **kwargs)
         except telebot.apihelper.ApiTelegramException as e:
-            msg = str(e).lower()
-            if "message to be replied not found" in msg or \
-               "message to reply not found" in msg or \
-               ("reply" in msg and "not found" in msg):
+            # 该类错误 Telegram 一律返回 400，先比错误码再用预编译正则匹配描述
+            if e.error_code == 400 and _REPLY_MISSING_RE.match(getattr(e, "description", None) or str(e)):
                 return self.bot.send_message(message.chat.id, text, **kwargs)
             else:
                 raise
@@ -476,24 +680,34 @@ class BotHelper:
             # --- 修改点开始 ---
             # 只有当 preserve_reply 为 False (默认) 时，才删除 Bot 的回复
             if sent_msg and not preserve_reply:
-                threading.Thread(
-                    target=self._delayed_delete,
-                    args=(message.chat.id, sent_msg.message_id, delete_delay),
-                    daemon=True
-                ).start()
+                self._schedule_delete(message.chat.id, sent_msg.message_id, delete_delay)
             # --- 修改点结束 ---
 
             # 用户的指令始终根据 delete_delay 删除
-            threading.Thread(
-                target=self._delayed_delete,
-                args=(message.chat.id, message.message_id, delete_delay),
-                daemon=True
-            ).start()
+            self._schedule_delete(message.chat.id, message.message_id, delete_delay)
 
         return sent_msg
 
-    def _delayed_delete(self, chat_id, message_id, delay):
-        time.sleep(delay)
+    def _schedule_delete(self, chat_id, message_id, delay):
+        with self._del_lock:
+            heapq.heappush(self._del_heap, (time.monotonic() + delay, chat_id, message_id))
+            self._del_wake.set()
+
+    def _delete_scheduler(self):
+        while True:
+            with self._del_lock:
+                now = time.monotonic()
+                due = []
+                while self._del_heap and self._del_heap[0][0] <= now:
+                    due.append(heapq.heappop(self._del_heap))
+                timeout = self._del_heap[0][0] - now if self._del_heap else None
+                self._del_wake.clear()
+            # 删除请求交给小线程池，Telegram 响应慢时不拖住调度
+            for _, chat_id, message_id in due:
+                self._del_executor.submit(self._delete_message, chat_id, message_id)
+            self._del_wake.wait(timeout=timeout)
+
+    def _delete_message(self, chat_id, message_id):
         try:
             self.bot.delete_message(chat_id, message_id)
         except Exception: